@@ -0,0 +1,282 @@
+"""
+Asynchronous client for remote Instaseis databases
+
+Every get_seismograms call on a remote database (an http:// URL) is a
+blocking request, so a noise record of many events mostly waits on the
+network.  AsyncClient sends the raw seismogram queries that instaseis
+itself uses (the /seismograms_raw route of the Instaseis server) through a
+single pooled keep-alive aiohttp session, with up to max_inflight requests
+in flight, so their latencies overlap.
+
+Connection errors, timeouts and 429/5xx responses are retried up to
+max_retries times, waiting noisetools.backoff_delay (exponential backoff
+with jitter) between attempts.  Queries that still fail are listed in the
+FetchStats of the client and yield None instead of a seismogram.
+
+Responses are turned into seismograms by to_stream, which does what
+get_seismograms of instaseis does with raw seismograms of a point source
+for the options the noise scripts use (displacement, without resampling or
+reconvolving the source time function).  Any Instaseis server works, e.g.
+one started locally on a test database with python -m instaseis.server.
+"""
+
+import noisetools
+import seiscache
+import asyncio
+import io
+import itertools
+import random
+import numpy as np
+import obspy
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+# HTTP statuses worth retrying, everything else but 200 fails at once
+retry_statuses = (408, 429, 500, 502, 503, 504)
+
+
+class FetchStats(object):
+    """
+    Counts of the queries of an AsyncClient, and the index and reason of
+    every failed query
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.cached = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = []
+
+    def report(self):
+        """
+        Function to return a one-line summary of the queries
+        """
+        return ('Remote queries: %d events, %d from cache, %d requests, '
+                '%d retries, %d failed' % (self.queries, self.cached,
+                                           self.requests, self.retries,
+                                           len(self.failures)))
+
+
+class AsyncClient(object):
+    """
+    Concurrent client of the Instaseis server at url
+    """
+
+    def __init__(self, url, max_inflight=8, max_retries=8, backoff=0.5,
+                 max_backoff=30.0, timeout=300.0, seed=None):
+        if aiohttp is None:
+            raise ImportError("AsyncClient needs aiohttp")
+        if max_inflight < 1:
+            raise ValueError("max_inflight must be at least 1")
+        (scheme, netloc, path) = urlparse(url)[:3]
+        if scheme not in ('http', 'https'):
+            raise ValueError("%s is not an http(s) URL" % url)
+        self.url = '%s://%s/' % (scheme, netloc)
+        if path.strip('/'):
+            self.url += path.strip('/') + '/'
+        self.url += 'seismograms_raw'
+        self.max_inflight = max_inflight
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+        self.stats = FetchStats()
+
+    def params(self, source, receiver, components):
+        """
+        Function to return the query parameters of a source and receiver
+        """
+        params = {'components': ''.join(components).upper(),
+                  'receiverlatitude': receiver.latitude,
+                  'receiverlongitude': receiver.longitude}
+        if getattr(receiver, 'depth_in_m', None) is not None:
+            params['receiverdepthinmeters'] = receiver.depth_in_m
+        if receiver.network:
+            params['networkcode'] = receiver.network
+        if receiver.station:
+            params['stationcode'] = receiver.station
+        params['sourcelatitude'] = source.latitude
+        params['sourcelongitude'] = source.longitude
+        if source.depth_in_m is not None:
+            params['sourcedepthinmeters'] = source.depth_in_m
+        for name in ('rr', 'tt', 'pp', 'rt', 'rp', 'tp'):
+            params['m' + name] = getattr(source, 'm_' + name)
+        # Same formatting as urlencode in instaseis
+        return dict((key, str(value)) for (key, value) in params.items())
+
+    async def _open(self):
+        connector = aiohttp.TCPConnector(limit=self.max_inflight)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return (session, asyncio.Semaphore(self.max_inflight))
+
+    async def _fetch(self, session, semaphore, params):
+        """
+        Function to query raw seismograms, with retries
+
+        Returns a tuple of data,reason with data the dictionary of
+        component arrays and mu returned by _get_seismograms of instaseis
+        databases, or None and the reason of the last failure
+        """
+        reason = None
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.stats.retries += 1
+                await asyncio.sleep(noisetools.backoff_delay(
+                    attempt - 1, self.backoff, self.max_backoff, self.rng))
+            async with semaphore:
+                self.stats.requests += 1
+                try:
+                    async with session.get(self.url, params=params) as r:
+                        status = r.status
+                        mu = r.headers.get('Instaseis-Mu')
+                        body = await r.read()
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    reason = '%s %s' % (type(e).__name__, e)
+                    continue
+            if status != 200:
+                reason = 'HTTP status %d' % status
+                if status in retry_statuses:
+                    continue
+                break
+            if mu is None:
+                reason = 'no Instaseis-Mu header'
+                break
+            try:
+                st = obspy.read(io.BytesIO(body))
+            except Exception as e:
+                # Most likely a truncated response
+                reason = 'unreadable response (%s)' % e
+                continue
+            data = {'mu': float(mu)}
+            for tr in st:
+                data[tr.stats.channel[-1].upper()] = tr.data
+            return (data, None)
+        return (None, reason)
+
+    async def _fetch_all(self, session, semaphore, queries):
+        return await asyncio.gather(*[self._fetch(session, semaphore, params)
+                                      for params in queries])
+
+    def seismograms(self, db, sources, receiver, batch=None, **kwargs):
+        """
+        Function to compute the seismograms of a sequence of sources
+
+        db is the (possibly seiscache.CachedDB) database opened at the same
+        URL, and kwargs are the get_seismograms options (see to_stream).  Sources are
+        queried batch (default 4*max_inflight) at a time, skipping those in
+        the cache of a CachedDB.
+
+        Yields an obspy Stream, or None if the query failed, for every
+        source in order
+        """
+        cache = None
+        if isinstance(db, seiscache.CachedDB):
+            (cache, db_id, db) = (db.cache, db.db_id, db.db)
+        components = kwargs.get('components')
+        if components is None:
+            components = getattr(db, 'default_components', ('Z', 'N', 'E'))
+        if batch is None:
+            batch = 4*self.max_inflight
+        sources = iter(sources)
+        loop = asyncio.new_event_loop()
+        try:
+            (session, semaphore) = loop.run_until_complete(self._open())
+            try:
+                while True:
+                    chunk = list(itertools.islice(sources, batch))
+                    if not chunk:
+                        break
+                    n0 = self.stats.queries
+                    self.stats.queries += len(chunk)
+                    streams = [None]*len(chunk)
+                    keys = [None]*len(chunk)
+                    if cache is not None:
+                        for (i, source) in enumerate(chunk):
+                            keys[i] = cache.key(db_id, source, receiver,
+                                                **kwargs)
+                            streams[i] = cache.get(keys[i])
+                    missing = [i for i in range(len(chunk))
+                               if streams[i] is None]
+                    self.stats.cached += len(chunk) - len(missing)
+                    queries = [self.params(chunk[i], receiver, components)
+                               for i in missing]
+                    results = loop.run_until_complete(
+                        self._fetch_all(session, semaphore, queries))
+                    for (i, (data, reason)) in zip(missing, results):
+                        if data is not None:
+                            try:
+                                streams[i] = to_stream(db, chunk[i], receiver,
+                                                       data, components,
+                                                       **kwargs)
+                            except Exception as e:
+                                reason = 'conversion failed (%s)' % e
+                        if streams[i] is None:
+                            self.stats.failures.append((n0 + i, reason))
+                        elif cache is not None:
+                            cache.put(keys[i], streams[i])
+                    for st in streams:
+                        yield st
+            finally:
+                loop.run_until_complete(session.close())
+        finally:
+            loop.close()
+
+
+def band_code(dt):
+    """
+    Function to return the SEED band code of a sampling interval, as
+    instaseis names its channels
+    """
+    for (limit, code) in ((0.001, 'F'), (0.004, 'C'), (0.0125, 'H'),
+                          (0.1, 'B'), (1.0, 'M')):
+        if dt <= limit:
+            return code
+    return 'L'
+
+def to_stream(db, source, receiver, data, components=('Z', 'N', 'E'),
+              kind='displacement', remove_source_shift=True,
+              reconvolve_stf=False, dt=None, **kwargs):
+    """
+    Function to compute the seismograms of a point source from the raw
+    data of a remote query (component arrays and mu) of the database db
+
+    Only the get_seismograms options of the noise scripts are supported:
+    displacement at the sampling of the database, without reconvolving the
+    source time function.  mu is only needed for finite sources.
+
+    Returns an obspy Stream
+    """
+    info = db.info
+    if kind != 'displacement':
+        raise ValueError("cannot compute %s seismograms" % kind)
+    if reconvolve_stf:
+        raise ValueError("cannot reconvolve the source time function")
+    if (dt is not None) and not np.isclose(dt, info.dt):
+        raise ValueError("cannot resample seismograms")
+    if kwargs:
+        raise ValueError("unsupported options %s" %
+                         ', '.join(sorted(kwargs)))
+    starttime = source.origin_time
+    shift = 0
+    if remove_source_shift:
+        shift = info.src_shift_samples
+    else:
+        starttime -= info.src_shift
+    st = obspy.Stream()
+    for comp in components:
+        header = {'delta': info.dt, 'starttime': starttime,
+                  'network': receiver.network, 'station': receiver.station,
+                  'location': receiver.location,
+                  'channel': '%sX%s' % (band_code(info.dt), comp)}
+        st += obspy.Trace(data=np.asarray(data[comp])[shift:],
+                          header=header)
+    return st
@@ -0,0 +1,263 @@
+"""
+Checkpoints of noise record computations
+
+A Checkpoint follows the events of a source plan as they are added to a
+noiserecord.SegmentWriter, and saves to an npz file every interval
+seconds: the run configuration, a bitmap of the events already added,
+the events that failed, the segments already written and the samples of
+the record that are not written yet.  Files are written to a temporary
+name and renamed, so a crash leaves the previous checkpoint intact.
+
+The segments overlapped by failed events are held back (see
+SegmentWriter), and their samples stay in the checkpoint until the events
+are added, while all other segments are written as usual.  The samples of
+a noiserecord.MappedRecord are copied block by block from its file to a
+file next to the checkpoint (filename.N.blocks), so they are never all in
+memory.
+
+Checkpoint.load restores a new writer to the saved state and refuses a
+checkpoint made with a different configuration, so a restart only
+computes the events missing from the bitmap.  Segments written after the
+checkpoint are written again, with the same data.
+"""
+
+import noiserecord
+import collections
+import hashlib
+import json
+import os
+import time
+import numpy as np
+
+
+class Checkpoint(object):
+    """
+    Progress of adding the events of a plan, starting at sample offsets
+    and npts samples long, to writer, saved to filename every interval
+    seconds (checkpoints are disabled if interval is 0)
+
+    Events are added in plan order, which must be time order if the record
+    is written in segments.  config is a JSON-serializable dictionary of
+    everything that sets the record, e.g. the catalog, database and
+    plan_hash of the plan.
+    """
+
+    def __init__(self, filename, writer, offsets, npts, config,
+                 interval=600.0):
+        self.filename = filename
+        self.writer = writer
+        self.offsets = np.asarray(offsets)
+        self.npts = npts
+        self.config = json.loads(json.dumps(config))
+        self.interval = interval
+        self.done = np.zeros(len(self.offsets), dtype=bool)
+        self.failed = set()
+        # Number of failed events in each segment
+        self.holds = collections.Counter()
+        self.finished = False
+        # First sample not reached by any event added so far
+        self.end = writer.written
+        self.saved = time.time()
+        # Number of saves, and file of the blocks of the last one
+        self.serial = 0
+        self.blocks = None
+
+    @classmethod
+    def load(cls, filename, writer, offsets, npts, config, interval=600.0):
+        """
+        Function to restore writer (with an empty record) to the state
+        saved in a checkpoint file
+        """
+        with np.load(filename) as f:
+            state = json.loads(str(f['state']))
+            done = np.unpackbits(f['done'])[:int(f['nevents'])]
+            window = f['window']
+        checkpoint = cls(filename, writer, offsets, npts, config,
+                         interval=interval)
+        if state['config'] != checkpoint.config:
+            changed = sorted(set(name for name in
+                                 set(state['config']) | set(checkpoint.config)
+                                 if state['config'].get(name) !=
+                                 checkpoint.config.get(name)))
+            raise ValueError("%s was made with a different %s" %
+                             (filename, ', '.join(changed)))
+        if len(done) != len(checkpoint.done):
+            raise ValueError("%s was made with a different plan" % filename)
+        checkpoint.done = done.astype(bool)
+        for n in state['failed']:
+            checkpoint.fail(n)
+        checkpoint.finished = state['finished']
+        checkpoint.serial = state['serial']
+        writer.written = state['written']
+        writer.segments = state['segments']
+        writer.held = set(state['held'])
+        ranges = state['ranges']
+        blocks = state['blocks']
+        if blocks is None:
+            n0 = 0
+            for (start, stop) in ranges:
+                writer.record.add(window[:, n0:n0 + stop - start], start)
+                n0 += stop - start
+        else:
+            checkpoint.blocks = os.path.join(os.path.dirname(filename),
+                                             blocks['file'])
+            _restore_blocks(checkpoint.blocks, blocks, writer.record)
+        checkpoint.end = max([writer.written] +
+                             [stop for (start, stop) in ranges])
+        return checkpoint
+
+    def _segments(self, n):
+        offset = int(self.offsets[n])
+        return self.writer.segments_of(offset, offset + self.npts)
+
+    def fail(self, n):
+        """
+        Function to mark event n of the plan as failed, holding back the
+        segments it overlaps until it is added
+        """
+        if n in self.failed:
+            return
+        self.failed.add(n)
+        for k in self._segments(n):
+            self.holds[k] += 1
+
+    def add(self, n, data):
+        """
+        Function to add the (ncomp, n) array of event n of the plan to the
+        writer, saving the checkpoint if it is due
+
+        Held segments are written once no failed event is left in them
+        """
+        offset = int(self.offsets[n])
+        self.writer.add(data, offset, hold=self.holds)
+        self.done[n] = True
+        released = []
+        if n in self.failed:
+            self.failed.discard(n)
+            for k in self._segments(n):
+                self.holds[k] -= 1
+                if self.holds[k] == 0:
+                    del self.holds[k]
+                    released.append(k)
+        for k in released:
+            if k in self.writer.held:
+                self.writer.write_segment(k)
+        self.end = max(self.end, min(offset + data.shape[1],
+                                     self.writer.nsamples))
+        if self.interval and (time.time() - self.saved >= self.interval):
+            self.save()
+
+    def save(self):
+        """
+        Function to write the checkpoint file
+        """
+        if not self.interval:
+            return
+        writer = self.writer
+        record = writer.record
+        # Samples of the held segments and of those not written yet
+        ranges = [[k*writer.segment, min((k + 1)*writer.segment,
+                                         writer.nsamples)]
+                  for k in sorted(writer.held)]
+        if (not self.finished) and (self.end > writer.written):
+            ranges.append([writer.written, self.end])
+        self.serial += 1
+        state = {'config': self.config, 'written': writer.written,
+                 'segments': writer.segments, 'held': sorted(writer.held),
+                 'failed': sorted(int(n) for n in self.failed),
+                 'finished': self.finished, 'serial': self.serial,
+                 'ranges': ranges, 'blocks': None}
+        blocks = None
+        window = np.zeros((record.ncomp, 0))
+        if isinstance(record, noiserecord.MappedRecord):
+            if ranges:
+                blocks = '%s.%d.blocks' % (self.filename, self.serial)
+                state['blocks'] = _copy_blocks(record, ranges, blocks)
+        elif ranges:
+            window = np.concatenate([record.read(start, stop)
+                                     for (start, stop) in ranges], axis=1)
+        tmpname = '%s.%d.tmp' % (self.filename, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, state=json.dumps(state),
+                     done=np.packbits(self.done), nevents=len(self.done),
+                     window=window)
+        os.replace(tmpname, self.filename)
+        # The previous blocks are only removed once the checkpoint no
+        # longer refers to them
+        _remove(self.blocks)
+        self.blocks = blocks
+        self.saved = time.time()
+
+    def finish(self, keep=False):
+        """
+        Function to write the remaining segments, then remove the
+        checkpoint file, or keep it marked as finished if keep is set
+
+        If events failed, their segments are written but listed as
+        incomplete in the segment index, and the checkpoint is saved to
+        add them later.  Returns True if the record is complete.
+        """
+        self.writer.close(hold=self.holds)
+        if self.failed:
+            self.save()
+            return False
+        self.finished = True
+        if keep:
+            self.save()
+        elif self.interval:
+            _remove(self.filename)
+            _remove(self.blocks)
+            self.blocks = None
+        return True
+
+
+def _copy_blocks(record, ranges, filename):
+    """
+    Function to copy the blocks of a MappedRecord file holding a list of
+    [start, stop] sample ranges to filename, one block at a time
+
+    Returns the dictionary describing the copy, saved in the checkpoint
+    state
+    """
+    record.flush()
+    parts = []
+    tmpname = '%s.%d.tmp' % (filename, os.getpid())
+    with open(record.filename, 'rb') as source:
+        with open(tmpname, 'wb') as f:
+            for (start, stop) in ranges:
+                k0 = start // record.block
+                k1 = -(-stop // record.block)
+                source.seek(k0*record.block_bytes)
+                for k in range(k0, k1):
+                    f.write(source.read(record.block_bytes))
+                parts.append([start, stop, k0])
+    os.replace(tmpname, filename)
+    return {'file': os.path.basename(filename), 'ranges': parts,
+            'block': record.block, 'ncomp': record.ncomp,
+            'dtype': record.dtype.str}
+
+def _restore_blocks(filename, blocks, record):
+    """
+    Function to add the sample ranges copied by _copy_blocks to an empty
+    record, one block at a time
+    """
+    (block, ncomp) = (blocks['block'], blocks['ncomp'])
+    with open(filename, 'rb') as f:
+        for (start, stop, k) in blocks['ranges']:
+            while k*block < stop:
+                data = np.fromfile(f, dtype=blocks['dtype'],
+                                   count=ncomp*block).reshape(ncomp, block)
+                i0 = max(start - k*block, 0)
+                i1 = min(stop - k*block, block)
+                record.add(data[:, i0:i1], k*block + i0)
+                k += 1
+
+def _remove(filename):
+    if (filename is not None) and os.path.exists(filename):
+        os.remove(filename)
+
+def plan_hash(plan):
+    """
+    Function to return the sha256 hex digest of a source plan
+    """
+    return hashlib.sha256(np.ascontiguousarray(plan).tobytes()).hexdigest()
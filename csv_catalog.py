@@ -11,7 +11,6 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pylab as P
 from tqdm import tqdm
-import cPickle as pickle
 import sys
 
 # Get catalog file from command line
@@ -21,8 +20,7 @@ else:
     sys.exit("Please specify the catalog pickle file as an argument")
 
 # Get the catalog from the pickle file
-with open(filein, 'rb') as f:
-    gr_obj = pickle.load(f)
+gr_obj = gr.load_catalog(filein)
 
 # Write out a csv file
 csv_out = filein + '.csv'
@@ -5,10 +5,7 @@ binary pickle file.  Randomize missing elements
 
 import gutenbergrichter as gr
 import math
-import random
 import numpy as np
-from tqdm import tqdm
-import csv
 import sys
 
 python3 = sys.version_info > (3,0)
@@ -41,43 +38,27 @@ gr_obj = gr.GutenbergRichter(b=slope, m0total=m0total, max_m0=max_m0,
 gr_obj.calc_a()
 Msamp = 0.25
 Mws = np.arange(minM, maxM + Msamp, Msamp)
-Nsec = gr_obj.get_N(Mws)/secyear
-Ns = np.zeros_like(Nsec)
 
+# Columns of the input file are time (days), Mw, longitude, latitude and
+# depth (m).  Convert them in bulk, one chunk of rows at a time, and use
+# random values for the other elements
+rng = np.random.default_rng()
 catalog = []
-evttime_max = -999.0
-evtdepth_max = 0.0
-with open(infile, 'r') as csvfile:
-    evtreader = csv.reader(csvfile)
-    evtreader.next() #skip header row
-    for row in evtreader:
-        evttime_days = float(row[0])
-        evttime = evttime_days * secday
-        if (evttime > evttime_max):
-            evttime_max = evttime
-        evtMw = float(row[1])
-        mask = (Mws < evtMw).astype(int)
-        Ns = Ns + mask
-        evtlon = float(row[2])
-        evtlat = 90.0 - float(row[3]) #convert to colatitude
-        evtdepth = float(row[4])*1.0e-3
-        if (evtdepth > evtdepth_max):
-            evtdepth_max = evtdepth
-        # For other values, use random values
-        strike = random.uniform(0,360)
-        rake = random.uniform(0,360)
-        dip = random.uniform(0,90)
-        catalog.append(np.array([evttime, evtMw, evtlat, evtlon, evtdepth,
-                                 strike, rake, dip]))
+for chunk in gr.iter_csv_chunks(infile, skiprows=1, usecols=(0, 1, 2, 3, 4)):
+    (strike, rake, dip) = gr.random_mechanisms(len(chunk), rng)
+    catalog.append(np.column_stack([chunk[:, 0]*secday, #time
+                                    chunk[:, 1], #Mw
+                                    90.0 - chunk[:, 3], #colatitude
+                                    chunk[:, 2], #longitude
+                                    chunk[:, 4]*1.0e-3, #depth
+                                    strike, rake, dip]))
 
-id_dict = {'time' : 0, 'magnitude' : 1, 'delta' : 2, 'backaz' : 3,
-           'depth' : 4, 'strike' : 5, 'rake' : 6, 'dip' : 7}
-catalog=np.array(catalog)
-length = evttime_max
-max_dep = evtdepth_max
+catalog = np.concatenate(catalog)
+length = catalog[:, 0].max()
+max_dep = max(catalog[:, 4].max(), 0.0)
 gr_obj.catalog = gr.Catalog(data=catalog, length=length, max_dep=max_dep,
-                            id_dict=id_dict, Mws=Mws, Ns=Ns)
-# This does not set Ns and Mws...  This should be fixed in gutenbergrichter.py
-    
+                            Mws=Mws)
+gr_obj.catalog.Ns = gr_obj.catalog.cumulative_counts(Mws)
+
 with open(outfile, 'wb') as f:
     pickle.dump(gr_obj, f, -1)
@@ -85,15 +85,6 @@ Nsec = Ns/secyear
 gr_obj.generate_catalog(catlength, max_dep=max_dep)
 
 # Plot it all up
-try:
-    time_id = gr_obj.catalog.id_dict['time']
-    mag_id = gr_obj.catalog.id_dict['magnitude']
-    delta_id = gr_obj.catalog.id_dict['delta']
-except AttributeError:
-    time_id = 0
-    mag_id = 1
-    delta_id = 2
-
 plt.figure(figsize=(10,15))
 plt.subplot(2, 1, 1)
 plt.semilogy(Mws, Ns, color="blue", linestyle="solid")
@@ -107,8 +98,8 @@ plt.ylabel("N")
 
 ndays = int(catlength/secday)
 plt.subplot(2, 1, 2)
-plt.scatter(gr_obj.catalog.data[:,time_id]/secday,
-            gr_obj.catalog.data[:,mag_id], facecolor='darkgreen')
+plt.scatter(gr_obj.catalog.time/secday,
+            gr_obj.catalog.magnitude, facecolor='darkgreen')
 plt.title("%d day catalog" % ndays)
 plt.xlabel("Day")
 plt.ylabel("Magnitude")
@@ -117,7 +108,7 @@ plt.ylim([0, 6])
 
 # Plt.subplot(3, 1, 3)
 # numBins = 30
-# plt.hist(gr_obj.catalog.data[:,delta_id],numBins,color='green')
+# plt.hist(gr_obj.catalog.delta,numBins,color='green')
 # plt.title("Distances")
 # plt.xlabel("Distance (degrees)")
 # plt.ylabel("Frequency")
@@ -135,15 +126,6 @@ with open(filename, 'wb') as f:
 gr_obj_lower.generate_catalog(catlength, max_dep=max_dep)
 
 # Plot it all up
-try:
-    time_id = gr_obj_lower.catalog.id_dict['time']
-    mag_id = gr_obj_lower.catalog.id_dict['magnitude']
-    delta_id = gr_obj_lower.catalog.id_dict['delta']
-except AttributeError:
-    time_id = 0
-    mag_id = 1
-    delta_id = 2
-
 plt.clf()
 plt.figure(figsize=(10,15))
 plt.subplot(2, 1, 1)
@@ -158,8 +140,8 @@ plt.ylabel("N")
 
 ndays = int(catlength/secday)
 plt.subplot(2, 1, 2)
-plt.scatter(gr_obj_lower.catalog.data[:,time_id]/secday,
-            gr_obj_lower.catalog.data[:,mag_id], facecolor='darkgreen')
+plt.scatter(gr_obj_lower.catalog.time/secday,
+            gr_obj_lower.catalog.magnitude, facecolor='darkgreen')
 plt.title("%d day catalog" % ndays)
 plt.xlabel("Day")
 plt.ylabel("Magnitude")
@@ -172,4 +154,4 @@ P.savefig(figname)
 # Write out catalog to pickle file
 filename = 'catalog_lower.pkl'
 with open(filename, 'wb') as f:
-    pickle.dump(gr_obj, f, -1)
+    pickle.dump(gr_obj_lower, f, -1)
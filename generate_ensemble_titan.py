@@ -0,0 +1,69 @@
+"""
+Calculate an ensemble of synthetic Titan catalogs matching a desired
+Gutenberg-Richter relationship, generating the realizations in parallel
+
+Usage: python generate_ensemble_titan.py [-n N] [-s SEED] [-p PROCESSES]
+                                         [prefix]
+
+Writes prefix_0.pkl ... prefix_(N-1).pkl (default catalogs/Titan_cycle) and
+a prefix_seeds.csv file recording the master seed and the realization
+number of each catalog.  Any member can be regenerated exactly with
+gr.ensemble_seed(master seed, realization).
+"""
+
+import gutenbergrichter as gr
+import argparse
+import csv
+import os
+
+# Basic characteristics of seismicity catalog, as in generate_catalog_titan.py
+# Updated with numbers from Hurford et al. (2020)
+m0totalpercycle = 2.7e15
+TCycleHrs = 382.7
+HrsYr = 24.0*365.0
+TCycleYrs = TCycleHrs/HrsYr
+m0total = m0totalpercycle/TCycleYrs
+max_m0 = 1.9e16
+minM = 0.0
+min_m0 = gr.calc_m0(minM)
+slope = 1.0
+secday = 60.0*60.0*24.0
+secyear = secday*365.0
+catlength = 10.0*TCycleYrs*secyear
+max_dep = 2.0 #max depth in km, events will be uniform between 0 and max_dep
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Generates an ensemble of '
+                                                  + 'reproducibly seeded '
+                                                  + 'Titan catalogs.'))
+    parser.add_argument('-n', '--nreal', type=int, default=10,
+                        help='Number of realizations')
+    parser.add_argument('-s', '--seed', type=int,
+                        help='Master seed (random if not given)')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of worker processes')
+    parser.add_argument('prefix', nargs='?', default='catalogs/Titan_cycle',
+                        help='Output filename prefix')
+    args = parser.parse_args()
+
+    outdir = os.path.dirname(args.prefix)
+    if outdir and not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    gr_obj = gr.GutenbergRichter(b=slope, m0total=m0total, max_m0=max_m0,
+                                 min_m0=min_m0)
+    gr_obj.calc_a()
+
+    (seed, members) = gr.generate_ensemble(gr_obj, catlength, args.nreal,
+                                           args.prefix + '_%d.pkl',
+                                           seed=args.seed, max_dep=max_dep,
+                                           processes=args.processes)
+
+    with open(args.prefix + '_seeds.csv', 'w') as f:
+        output = csv.writer(f)
+        output.writerow(['Realization', 'Filename', 'Master seed',
+                         'Events'])
+        for (realization, filename, nevents, moment) in members:
+            output.writerow([realization, filename, seed, nevents])
+            print('Wrote %s (%d events)' % (filename, nevents))
+    print('Master seed: %d' % seed)
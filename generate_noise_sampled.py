@@ -6,14 +6,19 @@ Usage: python generate_noise_sampled.py pklfile minMw dt
 
 All arguments are optional.  
 
-The first argument, if present, is assumed to be a catalog pickle file
-consistent with catalogs generated by gutenbergrichter.py
+The first argument, if present, is assumed to be a catalog pickle file or
+catalog directory consistent with catalogs generated by gutenbergrichter.py
 
 The second argument, if present, is assumed to be a minimum moment magnitude
 for calculation of waveforms.
 """
 
 import gutenbergrichter as gr
+import noisetools
+import seiscache
+import noiserecord
+import checkpoint
+import asyncclient
 import math
 import numpy as np
 import matplotlib
@@ -21,47 +26,10 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import pylab as P
 from tqdm import tqdm
-import obspy
 import instaseis
 import sys
+import os
 import argparse
-python3 = sys.version_info > (3,0)
-
-if python3:
-    import pickle
-else:
-    import cPickle as pickle
-    from requests.exceptions import ConnectionError
-
-def wtcoef(t,t1,t2,t3,t4):
-    """
-    Function to calculate cosine taper
-
-    returns weight coefficient between 0 and 1
-
-    cosine taper from 0 to 1 t1 < t < t2
-    1 for t2 < t < t3
-    cosine taper from 1 to 0 t3 < t < t4
-    0 for t < t1 or t > t2
-    """
-
-    if t3 > t4:
-        raise ValueError('wtcoef: t3>t4')
-    if t1 > t2:
-        raise ValueError('wtcoef: t1>t2')
-
-    if (t >= t2) and (t <= t3):
-        wt = 1.0
-    elif (t >= t4) or (t <= t1):
-        wt = 0.0
-    elif (t > t3) and (t < t4):
-        wt = 0.5 * (1.0 + math.cos(math.pi * (t - t3)/(t4 - t3)))
-    elif (t > t1) and (t < t2):
-        wt = 0.5 * (1.0 + math.cos(math.pi * (t - t2)/(t2 - t1)))
-    else:
-        print(t, t1, t2, t3, t4)
-        raise ValueError('wtcoef: this should be impossible')
-    return wt
 
 # Parse arguments
 parser = argparse.ArgumentParser(description=('Generates a long noise record '
@@ -74,6 +42,29 @@ parser.add_argument('-d', '--decimation', type=int,
                     help='Decimation factor for seismogram output')
 parser.add_argument('-s', '--sampling', type=float, default=30.0,
                     help='Sampling of stations in degrees')
+parser.add_argument('-i', '--inflight', type=int,
+                    help=('Query a remote Instaseis server asynchronously, '
+                          + 'with up to this many requests in flight'))
+parser.add_argument('--segment', type=noisetools.segment_seconds,
+                    help=('Write the records in segments of this many '
+                          + 'seconds (or day, or cycle for a tidal cycle) as '
+                          + 'they are completed'))
+parser.add_argument('--format', choices=('SAC', 'MSEED'), default='SAC',
+                    help='Output format (MSEED is Steim-2 compressed)')
+parser.add_argument('--no-plot', action='store_true',
+                    help='Do not plot the records or their segments')
+parser.add_argument('--checkpoint-interval', type=float, default=10.0,
+                    help=('Minutes between checkpoints of each station, 0 to '
+                          + 'disable checkpoints'))
+parser.add_argument('--resume', action='store_true',
+                    help=('Skip finished stations and resume the others from '
+                          + 'their checkpoints'))
+parser.add_argument('--cache', default=seiscache.default_cache_dir,
+                    help='Directory of the on-disk seismogram cache')
+parser.add_argument('--cache-size', type=float, default=10.0,
+                    help='Size limit of the seismogram cache (GB)')
+parser.add_argument('--no-cache', action='store_true',
+                    help='Always query the Instaseis database')
 parser.add_argument('pklfile', nargs='?',
                     help='Input catalog pickle file')
 args = parser.parse_args()
@@ -98,11 +89,7 @@ secmonth = secday*30.0
 if (args.pklfile is not None): #Assumes argv[1] is pickle file
     filename = args.pklfile
     root = '.'.join(filename.split('.')[:-1])
-    with open(filename, 'rb') as f:
-        if python3:
-            gr_obj = pickle.load(f, encoding='latin1')
-        else:
-            gr_obj = pickle.load(f)
+    gr_obj = gr.load_catalog(filename)
     minM = gr.calc_Mw(gr_obj.min_m0)
     maxM = gr.calc_Mw(gr_obj.max_m0)
     Msamp = 0.25
@@ -145,29 +132,11 @@ else:
     catlength = 2.0*secday
     gr_obj.generate_catalog(catlength)
 
-def limit_depth(db, depth):
-    # Hack: If source depth is larger than maximum depth of
-    #       database, scale it to range (0, max_depth)
-    #       Assumes that catalog maximum depth is 10 km, which
-    #       is the hardcoded value right now.
-    radius = db.info.planet_radius
-    db_maxdepth = db.info.planet_radius - db.info.min_radius
-    if (depth > db_maxdepth): 
-        depth *= db_maxdepth / 10e3
-    return depth
-
 #(catalog2, Nsc2, Mwsc2) = gr_obj.generate_catalog(secmonth)
 
-# Plot it all up
-try:
-    time_id = gr_obj.catalog.id_dict['time']
-    mag_id = gr_obj.catalog.id_dict['magnitude']
-    delta_id = gr_obj.catalog.id_dict['delta']
-except AttributeError:
-    time_id = 0
-    mag_id = 1
-    delta_id = 2
+catalog = gr_obj.catalog
 
+# Plot it all up
 plt.figure(figsize=(10,15))
 plt.subplot(3, 1, 1)
 plt.semilogy(Mws, Ns, gr_obj.catalog.Mws, gr_obj.catalog.Ns)
@@ -180,8 +149,7 @@ secday = 60.0*60.0*24.0
 secyear = secday*365.0
 catlength = gr_obj.catalog.length
 ndays = int(catlength/secday)
-plt.scatter(gr_obj.catalog.data[:,time_id]/secday,
-            gr_obj.catalog.data[:,mag_id])
+plt.scatter(catalog.time/secday, catalog.magnitude)
 plt.title("%d day catalog" % ndays)
 plt.xlabel("Day")
 plt.ylabel("Magnitude")
@@ -189,7 +157,7 @@ plt.xlim([0, ndays])
 
 plt.subplot(3, 1, 3)
 numBins = 30
-plt.hist(gr_obj.catalog.data[:,delta_id],numBins,color='green')
+plt.hist(catalog.delta,numBins,color='green')
 plt.title("Distances")
 plt.xlabel("Distance (degrees)")
 plt.ylabel("Frequency")
@@ -201,7 +169,13 @@ P.savefig(figname)
 # Now we use instaseis to make a noise record
 # db = instaseis.open_db("Instaseis_test/prem_a_20s")
 # db = instaseis.open_db("/Volumes/Samsung/EuropaZbLowVUpper30kmMantle20km0WtPctMgSO4")
-db = instaseis.open_db(instaseisDB)
+# Look seismograms up on disk before querying the (remote) database
+if args.no_cache:
+    cache_dir = None
+else:
+    cache_dir = args.cache
+db = noisetools.open_database(instaseisDB, cache_dir=cache_dir,
+                              max_bytes=int(args.cache_size*1024**3))
 
 # Initialize noise record
 dbdt = db.info['dt']
@@ -212,19 +186,13 @@ else:
 dbnpts = db.info['npts']
 dblen = dbnpts * dbdt
 nsamples = int(gr_obj.catalog.length/dt_out) + int(dblen/dt_out)
-noise = np.zeros((3,nsamples))
 
-# Create taper windowing function. Can be done once, since all
-# seismograms should have the same length
+# Create taper windowing function and decimation filter. Can be done once,
+# since all seismograms should have the same length
 # Taper the end of the data to avoid abrupt endings
-t1 = 0
-t2 = 0
-t4 = int(dbnpts * (1 - endCutFrac)) - 1
-t3 = int(t4 - taperFrac * db.info.npts)
-
-wt = np.zeros(dbnpts)
-for s in range(dbnpts):
-    wt[s] = wtcoef(s, t1, t2, t3, t4)
+post = noisetools.get_postprocessor(dbnpts, dbdt, factor=args.decimation,
+                                    taperFrac=taperFrac,
+                                    endCutFrac=endCutFrac)
 
 
 # Reciever is placed at sampled spots on sphere
@@ -233,27 +201,34 @@ lats = np.arange(-90.0, 90.0, args.sampling) + 0.5 * args.sampling
 # receiver = instaseis.Receiver(latitude=90.0, longitude=0.0, network="XX",
 #                               station="EURP")
 
-# Loop on sources and make seismograms with InstaSeis
-nevents = gr_obj.catalog.data.shape[0]
-try:
-    time_id = gr_obj.catalog.id_dict['time']
-    mag_id = gr_obj.catalog.id_dict['magnitude']
-    delta_id = gr_obj.catalog.id_dict['delta']
-    baz_id = gr_obj.catalog.id_dict['backaz']
-    depth_id = gr_obj.catalog.id_dict['depth']
-    strike_id = gr_obj.catalog.id_dict['strike']
-    rake_id = gr_obj.catalog.id_dict['rake']
-    dip_id = gr_obj.catalog.id_dict['dip']
-except AttributeError:
-    time_id = 0
-    mag_id = 1
-    delta_id = 2
-    baz_id = 3
-    depth_id = 4
-    strike_id = 5
-    rake_id = 6
-    dip_id = 7
+# Compute source locations, depths, moment tensors and sample offsets of
+# all events at once.  Sources are placed relative to a receiver at the pole,
+# so the plan is the same for every station.
+nevents = len(catalog)
+(plan, mask) = noisetools.plan_sources(catalog, dt_out,
+                                       noisetools.db_max_depth(db),
+                                       min_Mw=min_Mw if setmin else None)
+# The output headers come from the seismograms of the first event
+if len(plan) == 0:
+    if setmin:
+        sys.exit('No events of the catalog are above magnitude %.2f' %
+                 min_Mw)
+    sys.exit('The catalog has no events')
+# Segments are written as soon as no later event reaches them, which needs
+# the events in time order
+if args.segment is None:
+    segment = None
+else:
+    segment = int(round(args.segment/dt_out))
+    if np.any(np.diff(plan.offset) < 0):
+        plan = plan[np.argsort(plan.offset, kind='stable')]
+# The catalog path is listed in the segment indexes, for manifest.py
+if args.pklfile is None:
+    catalog_path = None
+else:
+    catalog_path = os.path.abspath(args.pklfile)
 
+# Loop on sources and make seismograms with InstaSeis
 nstations = len(lons) * len(lats)
 n = 0
 for lon in lons:
@@ -263,64 +238,80 @@ for lon in lons:
               str(lat) + ' lon ' + str(lat))
         receiver = instaseis.Receiver(latitude=90.0, longitude=0.0,
                                       network="XX", station="TITN")        
-        for evt in tqdm(range(0, nevents)):
-            if (setmin and gr_obj.catalog.data[evt, mag_id] < min_Mw):
-                continue
-            latitude = 90.0 - gr_obj.catalog.data[evt, delta_id]
-            longitude = gr_obj.catalog.data[evt, baz_id]
-            if longitude > 180.0:
-                longitude -= 360.0
-            depth = limit_depth(db, 
-                                gr_obj.catalog.data[evt, depth_id] * 1000.)
-            strike = gr_obj.catalog.data[evt, strike_id]
-            rake = gr_obj.catalog.data[evt, rake_id]
-            dip = gr_obj.catalog.data[evt, dip_id]
-            M0 = gr.calc_m0(gr_obj.catalog.data[evt, mag_id])
-            source = instaseis.Source.from_strike_dip_rake(latitude=latitude,
-                                                           longitude=longitude,
-                                                           depth_in_m=depth,
-                                                           strike=strike,
-                                                           rake=rake,
-                                                           dip=dip, M0=M0)
+        # Seismograms of the first event give the headers of the output
+        st = noisetools.fetch_seismograms(db,
+                                          noisetools.make_source(plan[0]),
+                                          receiver, maxRetry)
+        if st is None:
+            sys.exit('Could not get the output headers from ' + instaseisDB)
+        stats = [tr.stats.copy() for tr in st]
+        for trstats in stats:
+            trstats.delta = dt_out
+        # Each station has its own record and checkpoint
+        station_root = '%s.%.1f.%.1f' % (db_short, lat, lon)
+        noise = noiserecord.MemoryRecord(3, nsamples)
+        writer = noiserecord.SegmentWriter(noise, stats, station_root,
+                                           segment=segment,
+                                           format=args.format,
+                                           plot=not args.no_plot,
+                                           catalog=catalog_path)
+        config = {'catalog': args.pklfile, 'plan': checkpoint.plan_hash(plan),
+                  'database': instaseisDB, 'decimation': args.decimation,
+                  'nsamples': nsamples, 'segment': segment,
+                  'format': args.format, 'station': station_root}
+        checkpoint_file = station_root + '.checkpoint.npz'
+        interval = 60.0*args.checkpoint_interval
+        if args.resume and os.path.exists(checkpoint_file):
             try:
-                st = db.get_seismograms(source=source, receiver=receiver,
-                                        remove_source_shift=False)
-                for tr in st: #Apply taper before decimation
-                    tr.data = np.multiply(wt, tr.data)
-                if (args.decimation is not None): #decimate if requested
-                    st.decimate(factor=args.decimation)
-            except (ConnectionError, TypeError): # Catch http-related errors and retry 
-                for i in range(maxRetry):
-                    try:
-                        st = db.get_seismograms(source=source, receiver=receiver,
-                                                remove_source_shift=False)
-                    except (ConnectionError, TypeError):
-                        continue
-                    break
-                else:
-                    print("Could not connect after max retries")
-
-
-            s1 = int(gr_obj.catalog.data[evt, time_id]/dt_out)
-            s2 = s1 + len(st[0].data) 
-
-            noise[0, s1:s2] += st[0].data
-            noise[1, s1:s2] += st[1].data
-            noise[2, s1:s2] += st[2].data
-
-
-        # Hijack the last stream object to dump the long trace in
-        for ist in range(3):
-            st[ist].data = noise[ist,:]
-            st[ist].stats['npts'] = nsamples
-
-        st.plot(outfile='noise.png')
-        print(st)
-        st[0].stats
-
-        for tr in st:
-            tr.write('%s.%.1f.%.1f.%s' %
-                     (db_short, lat, lon, tr.stats.channel), format='SAC')
+                progress = checkpoint.Checkpoint.load(checkpoint_file, writer,
+                                                      plan.offset,
+                                                      post.npts_out, config,
+                                                      interval=interval)
+            except ValueError as e:
+                sys.exit('Cannot resume: %s' % e)
+            if progress.finished:
+                print('Station already finished')
+                continue
+        else:
+            progress = checkpoint.Checkpoint(checkpoint_file, writer,
+                                             plan.offset, post.npts_out,
+                                             config, interval=interval)
+        todo = np.flatnonzero(~progress.done)
+        events = plan[todo]
+
+        if args.inflight is not None:
+            # Overlap the requests to the server
+            client = asyncclient.AsyncClient(instaseisDB,
+                                             max_inflight=args.inflight,
+                                             max_retries=maxRetry)
+            sources = (noisetools.make_source(event) for event in events)
+            seismograms = client.seismograms(db, sources, receiver,
+                                             remove_source_shift=False)
+        else:
+            seismograms = (noisetools.fetch_seismograms(
+                db, noisetools.make_source(event), receiver, maxRetry)
+                           for event in events)
+        # Taper and decimate (if requested) all components at once
+        results = noisetools.processed(seismograms, post)
+        try:
+            for (i, data) in zip(todo, tqdm(results, total=len(todo))):
+                if data is None:
+                    progress.fail(i)
+                    continue
+                progress.add(i, data)
+        except (Exception, KeyboardInterrupt):
+            progress.save()
+            raise
+
+        if args.inflight is not None:
+            print(client.stats.report())
+        if cache_dir is not None:
+            print(db.cache.report())
+        # Write the remaining segments, and mark the station finished
+        if not progress.finish(keep=True):
+            print('Warning: %d of %d events missing from the record, in '
+                  'the segments listed as incomplete in %s.segments.json' %
+                  (len(progress.failed), len(plan), station_root))
 
 # Break stream into individual traces for writing to sac files
 #st0 = st[0:1]
@@ -0,0 +1,219 @@
+"""
+Green's-function bank for computing noise records without one Instaseis
+query per event
+
+With the receiver at the north pole, the vertical, radial and transverse
+seismograms of a source depend only on its epicentral distance, its depth
+and its moment tensor (in the local frame of the source), and are linear
+in the moment tensor.  A GreensBank holds the Z, R and T responses to the
+six elementary moment tensors on a grid of distances and depths.  Each
+event is then the combination of the responses at the four surrounding
+grid nodes, weighted by its moment tensor components and bilinear
+interpolation weights, and rotated to N and E with its back azimuth
+(180 deg minus its longitude).
+
+Tapering and decimation are linear too, so they are applied to the bank
+once (see noisetools.PostProcessor) rather than to every event.
+Interpolating between distances smooths arrivals that move between grid
+nodes, so compare (or generate_noise.py --bank-check) reports the misfit
+to direct Instaseis seismograms for the grid used.
+"""
+
+import seiscache
+import json
+import numpy as np
+import instaseis
+from tqdm import tqdm
+
+bank_components = ('Z', 'R', 'T')
+mt_components = ('m_rr', 'm_tt', 'm_pp', 'm_rt', 'm_rp', 'm_tp')
+
+
+class GreensBank(object):
+    """
+    Z, R and T responses to the six unit moment tensors on a grid of
+    distances (deg) and depths (m), in an array of shape
+    (ndistances, ndepths, 6, 3, npts)
+
+    db_id identifies the database (see seiscache.database_id) and post_key
+    is the key of the noisetools.PostProcessor applied to the responses,
+    so that a saved bank is only reused for the same ones.
+    """
+
+    def __init__(self, distances, depths, data, dt, db_id=None,
+                 post_key=None):
+        self.distances = np.asarray(distances, dtype=np.float64)
+        self.depths = np.asarray(depths, dtype=np.float64)
+        self.data = data
+        self.dt = dt
+        self.npts = data.shape[-1]
+        self.db_id = db_id
+        self.post_key = _post_key(post_key)
+
+    @classmethod
+    def build(cls, db, distances, depths, post=None, receiver=None,
+              dtype=np.float32, db_id=None):
+        """
+        Function to compute a bank from an Instaseis database
+
+        post, a noisetools.PostProcessor, is applied to every response.
+        Distances are kept just inside the range of the database, since
+        the back azimuth is undefined at 0 and 180 deg.  db_id identifies
+        the database, and defaults to seiscache.database_id(db).
+        """
+        if db_id is None:
+            db_id = seiscache.database_id(db)
+        if receiver is None:
+            receiver = instaseis.Receiver(latitude=90.0, longitude=0.0,
+                                          network="XX", station="EURP")
+        min_d = max(db.info.min_d, 0.01)
+        max_d = min(db.info.max_d, 179.99)
+        data = None
+        nodes = [(i, j) for i in range(len(distances))
+                 for j in range(len(depths))]
+        for (i, j) in tqdm(nodes):
+            latitude = 90.0 - np.clip(distances[i], min_d, max_d)
+            for k in range(len(mt_components)):
+                tensor = dict((name, 1.0 if n == k else 0.0)
+                              for (n, name) in enumerate(mt_components))
+                source = instaseis.Source(latitude=latitude, longitude=0.0,
+                                          depth_in_m=depths[j], **tensor)
+                st = db.get_seismograms(source=source, receiver=receiver,
+                                        components=bank_components,
+                                        remove_source_shift=False)
+                zrt = np.array([tr.data for tr in st])
+                if post is not None:
+                    zrt = post(zrt)
+                if data is None:
+                    data = np.zeros((len(distances), len(depths),
+                                     len(mt_components), 3, zrt.shape[1]),
+                                    dtype=dtype)
+                data[i, j, k] = zrt
+        if post is None:
+            dt = db.info.dt
+        else:
+            dt = post.dt_out
+        return cls(distances, depths, data, dt, db_id=db_id,
+                   post_key=None if post is None else post.key)
+
+    def save(self, filename):
+        """
+        Function to write the bank to an npz file
+        """
+        np.savez(filename, distances=self.distances, depths=self.depths,
+                 data=self.data, dt=self.dt,
+                 origin=json.dumps({'db': self.db_id,
+                                    'post': self.post_key}))
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Function to read a bank written by save
+
+        Banks saved without their database and processing never match
+        """
+        with np.load(filename) as f:
+            if 'origin' in f:
+                origin = json.loads(str(f['origin']))
+            else:
+                origin = {'db': None, 'post': None}
+            return cls(f['distances'], f['depths'], f['data'],
+                       float(f['dt']), db_id=origin['db'],
+                       post_key=origin['post'])
+
+    def matches(self, distances, depths, dt, db_id=None, post=None):
+        """
+        Function to check whether the bank has a given grid and sampling,
+        and was computed from the database db_id with the PostProcessor
+        post
+        """
+        return (np.array_equal(self.distances, distances) and
+                np.array_equal(self.depths, depths) and
+                np.isclose(self.dt, dt) and (self.db_id is not None) and
+                (self.db_id == db_id) and
+                (self.post_key == _post_key(None if post is None
+                                            else post.key)))
+
+    def synthesize(self, event):
+        """
+        Function to compute the Z, N and E seismograms of a source record
+        from noisetools.plan_sources
+
+        Returns a (3, npts) array
+        """
+        (i, wi) = _bracket(self.distances, 90.0 - event.latitude)
+        (j, wj) = _bracket(self.depths, event.depth_in_m)
+        tensor = np.array([event[name] for name in mt_components])
+        # Bilinear weights of the four nodes times the tensor components
+        weights = np.array([(1.0 - wi)*(1.0 - wj), (1.0 - wi)*wj,
+                            wi*(1.0 - wj), wi*wj])
+        coefs = (weights[:, np.newaxis]*tensor).ravel()
+        nodes = self.data[[i, i, i + 1, i + 1], [j, j + 1, j, j + 1]]
+        (z, r, t) = np.dot(coefs, nodes.reshape(len(coefs), -1)
+                           ).reshape(3, self.npts)
+
+        phi = np.deg2rad(event.longitude)
+        return np.array([z, r*np.cos(phi) + t*np.sin(phi),
+                         -r*np.sin(phi) + t*np.cos(phi)])
+
+
+def _post_key(key):
+    """
+    Function to return a PostProcessor key as it reads back from JSON
+    """
+    if key is None:
+        return None
+    return json.loads(json.dumps(list(key)))
+
+def _bracket(nodes, x):
+    """
+    Function to find the grid interval holding x
+
+    Returns a tuple of i,w with x between nodes[i] and nodes[i+1] at
+    fraction w (clamped to the grid)
+    """
+    if len(nodes) == 1:
+        return (0, 0.0)
+    i = int(np.clip(np.searchsorted(nodes, x, side='right') - 1, 0,
+                    len(nodes) - 2))
+    w = (x - nodes[i])/(nodes[i + 1] - nodes[i])
+    return (i, float(np.clip(w, 0.0, 1.0)))
+
+def default_grid(step=0.5, max_depth=2000.0, ndepths=3):
+    """
+    Function to return a grid of distances every step deg from 0 to 180
+    and ndepths depths (m) from 0 to max_depth
+
+    Returns a tuple of distances,depths
+    """
+    distances = np.linspace(0.0, 180.0, int(round(180.0/step)) + 1)
+    depths = np.linspace(0.0, max_depth, ndepths)
+    return (distances, depths)
+
+def compare(bank, db, plan, post=None, receiver=None):
+    """
+    Function to compare bank seismograms with direct Instaseis seismograms
+    for a set of source records
+
+    Returns an array of relative misfits, ||bank - direct||/||direct||, with
+    one row per event and one column per component (Z, N, E)
+    """
+    if receiver is None:
+        receiver = instaseis.Receiver(latitude=90.0, longitude=0.0,
+                                      network="XX", station="EURP")
+    misfit = np.zeros((len(plan), 3))
+    for (n, event) in enumerate(plan):
+        source = instaseis.Source(latitude=event.latitude,
+                                  longitude=event.longitude,
+                                  depth_in_m=event.depth_in_m,
+                                  **dict((name, event[name])
+                                         for name in mt_components))
+        st = db.get_seismograms(source=source, receiver=receiver,
+                                remove_source_shift=False)
+        direct = np.array([tr.data for tr in st])
+        if post is not None:
+            direct = post(direct)
+        synthetic = bank.synthesize(event)
+        misfit[n] = (np.linalg.norm(synthetic - direct, axis=1) /
+                     np.linalg.norm(direct, axis=1))
+    return misfit
@@ -20,12 +20,20 @@ All N values are assumed to be normalized to 1 Earth year
 
 import math
 import numpy as np
-import random
-from tqdm import tqdm
 import csv
+import json
+import os
+import copy
+import pickle
+import multiprocessing
+import shutil
+import sys
+import sourcemodels
+import itertools
 
 secday = 24.0*60.0*60.0
 secyear = secday*365.0
+seccycle = 382.7*60.0*60.0 # Titan tidal cycle
 rad2deg = 180.0/math.pi
 
 # Default values for catalogs
@@ -34,28 +42,777 @@ max_m0 = math.pow(10.0, 19.5)
 slope = 1.0
 default_catlength = 2.0*secday
 
+# Fields of a Catalog, in the column order of Catalog.data
+catalog_fields = ('time', 'magnitude', 'delta', 'backaz', 'depth', 'strike',
+                  'rake', 'dip')
+catalog_ids = dict((name, i) for (i, name) in enumerate(catalog_fields))
+
+# On-disk catalog format written by GutenbergRichter.save_catalog
+catalog_format = 'grcat'
+catalog_format_version = 1
+gr_params = ('a', 'b', 'm0total', 'max_m0', 'min_m0', 'max_dep', 'mA', 'mB')
+
+# Event column headers and chunk size of catalog csv files
+csv_columns = ['Time', 'Mw', 'Colatitude', 'Longitude', 'Depth', 'Strike',
+               'Rake', 'Dip']
+csv_chunksize = 100000
+
+
+def _column_property(name):
+    """
+    Function to make a named accessor for one Catalog column
+    """
+
+    def getter(self):
+        return self._columns[name]
+
+    def setter(self, values):
+        self._set_column(name, values)
+
+    return property(getter, setter,
+                    doc="%s of each event (array view, no copy)" % name)
+
 
 class Catalog(object):
     """
     An object with an event catalog generated from a GutenbergRichter object
+
+    Events are stored as one contiguous array per field, available as
+    catalog.time, catalog.magnitude, catalog.delta, catalog.backaz,
+    catalog.depth, catalog.strike, catalog.rake and catalog.dip.  With
+    compact=True every field except time is stored as float32, which
+    roughly halves the memory of a catalog; time stays float64 so that
+    multi-year catalogs keep sub-second resolution.
+
+    Window queries (time_window, magnitude_above, query) use a sorted time
+    index and a magnitude-sorted permutation, and the statistics methods
+    (cumulative_counts, b_value, moment, moment_per_cycle, rate) memoize
+    their results.  All of these are built on first use and dropped
+    whenever a column is replaced.  Call invalidate() after modifying a
+    column in place.
     """
 
+    __slots__ = ('_columns', '_cache', 'length', 'max_dep', 'Mws', 'Ns',
+                 'seed', 'compact')
+
     def __init__(self, data=None, max_dep=None, length=None, Mws=None,
-                 Ns=None, id_dict=None):
+                 Ns=None, id_dict=None, seed=None, columns=None,
+                 compact=False):
         """
         An object to hold event catalog data
 
-        data should be an array to hold the catalog data for each event
+        data should be an array to hold the catalog data for each event,
+        with columns given by id_dict (defaults to catalog_ids).
+        Alternatively, columns can be a dict of one array per field.
         catlength is the duration of the catalog in seconds
         Mws and Ns are the magnitude and N values for the G-R plot
+        seed is the (master seed, realization) pair for ensemble members
         """
 
-        self.data = data
+        self.compact = compact
         self.length = length
         self.max_dep = max_dep
         self.Mws = Mws
         self.Ns = Ns
-        self.id_dict = id_dict
+        self.seed = seed
+        self._columns = {}
+        self._cache = {}
+        if columns is not None:
+            for name in catalog_fields:
+                self._set_column(name, columns[name])
+        else:
+            self._set_data(data, id_dict)
+
+    time = _column_property('time')
+    magnitude = _column_property('magnitude')
+    delta = _column_property('delta')
+    backaz = _column_property('backaz')
+    depth = _column_property('depth')
+    strike = _column_property('strike')
+    rake = _column_property('rake')
+    dip = _column_property('dip')
+
+    def _dtype(self, name):
+        if self.compact and name != 'time':
+            return np.float32
+        return np.float64
+
+    def _set_column(self, name, values):
+        self._columns[name] = np.ascontiguousarray(values,
+                                                   dtype=self._dtype(name))
+        self._cache = {}
+
+    def invalidate(self):
+        """
+        Function to drop cached indices after columns are modified in place
+        """
+        self._cache = {}
+
+    def _time_index(self):
+        """
+        Returns a tuple of order,times with times sorted and order the
+        permutation that sorts them (None if the catalog is time-ordered)
+        """
+        if 'time_index' not in self._cache:
+            time = self._columns['time']
+            if np.all(time[1:] >= time[:-1]):
+                self._cache['time_index'] = (None, time)
+            else:
+                order = np.argsort(time, kind='stable')
+                self._cache['time_index'] = (order, time[order])
+        return self._cache['time_index']
+
+    def _magnitude_index(self):
+        """
+        Returns a tuple of order,magnitudes with magnitudes sorted and order
+        the permutation that sorts them
+        """
+        if 'magnitude_index' not in self._cache:
+            magnitude = self._columns['magnitude']
+            order = np.argsort(magnitude, kind='stable')
+            self._cache['magnitude_index'] = (order, magnitude[order])
+        return self._cache['magnitude_index']
+
+    def _memoize(self, key, func):
+        """
+        Function to return the cached result for key, computing it with
+        func on first use.  Cached arrays are made read-only.
+        """
+        if key not in self._cache:
+            result = func()
+            if isinstance(result, np.ndarray):
+                result.flags.writeable = False
+            self._cache[key] = result
+        return self._cache[key]
+
+    def time_window(self, t1=None, t2=None):
+        """
+        Function to find the events with t1 <= time < t2
+
+        Returns an index usable on any column: a slice when the catalog is
+        time-ordered (as generated catalogs are), otherwise a view of the
+        sorted time permutation.  Either way no event data is copied.
+        """
+        (order, times) = self._time_index()
+        i1 = 0 if t1 is None else np.searchsorted(times, t1, side='left')
+        i2 = len(times) if t2 is None else np.searchsorted(times, t2,
+                                                           side='left')
+        i2 = max(i1, i2)
+        if order is None:
+            return slice(int(i1), int(i2))
+        return order[i1:i2]
+
+    def magnitude_above(self, min_Mw, max_Mw=None):
+        """
+        Function to find the events with min_Mw <= magnitude < max_Mw
+
+        Returns a view of the magnitude-sorted permutation, in increasing
+        magnitude order
+        """
+        (order, mags) = self._magnitude_index()
+        i1 = np.searchsorted(mags, min_Mw, side='left')
+        i2 = len(mags) if max_Mw is None else np.searchsorted(mags, max_Mw,
+                                                              side='left')
+        return order[i1:max(i1, i2)]
+
+    def query(self, t1=None, t2=None, min_Mw=None, max_Mw=None):
+        """
+        Function to find the events between t1 and t2 with magnitude
+        between min_Mw and max_Mw
+
+        Returns an array of event indices in time order.  Both indices are
+        searched and only the smaller candidate set is scanned.
+        """
+        window = self.time_window(t1, t2)
+        if isinstance(window, slice):
+            window = np.arange(window.start, window.stop)
+        if min_Mw is None and max_Mw is None:
+            return window
+        if min_Mw is None:
+            min_Mw = -np.inf
+        mag_window = self.magnitude_above(min_Mw, max_Mw)
+        if len(window) <= len(mag_window):
+            index = window
+            mags = self._columns['magnitude'][index]
+            mask = mags >= min_Mw
+            if max_Mw is not None:
+                mask &= mags < max_Mw
+            return index[mask]
+        times = self._columns['time'][mag_window]
+        mask = np.ones(len(mag_window), dtype=bool)
+        if t1 is not None:
+            mask &= times >= t1
+        if t2 is not None:
+            mask &= times < t2
+        index = mag_window[mask]
+        return index[np.argsort(self._columns['time'][index], kind='stable')]
+
+    def _set_data(self, data, id_dict=None):
+        if id_dict is None:
+            id_dict = catalog_ids
+        if data is None:
+            data = np.empty((0, len(catalog_fields)))
+        data = np.asarray(data).reshape(-1, len(catalog_fields))
+        for name in catalog_fields:
+            self._set_column(name, data[:, id_dict[name]])
+
+    @property
+    def data(self):
+        """
+        All fields as an (nevents, 8) float64 array laid out as catalog_ids
+
+        This is a copy, kept for code written against the old 2-D layout;
+        use the named columns to avoid it
+        """
+        return np.column_stack([self._columns[name].astype(np.float64)
+                                for name in catalog_fields])
+
+    @data.setter
+    def data(self, data):
+        self._set_data(data)
+
+    @property
+    def id_dict(self):
+        return dict(catalog_ids)
+
+    @property
+    def nbytes(self):
+        return sum(column.nbytes for column in self._columns.values())
+
+    def __len__(self):
+        return len(self._columns['time'])
+
+    def __getstate__(self):
+        return {'columns': self._columns, 'length': self.length,
+                'max_dep': self.max_dep, 'Mws': self.Mws, 'Ns': self.Ns,
+                'seed': self.seed, 'compact': self.compact}
+
+    def __setstate__(self, state):
+        # Catalogs pickled before the columnar layout hold a 2-D data array
+        # and an id_dict instead of columns
+        self.__init__(data=state.get('data'), max_dep=state.get('max_dep'),
+                      length=state.get('length'), Mws=state.get('Mws'),
+                      Ns=state.get('Ns'), id_dict=state.get('id_dict'),
+                      seed=state.get('seed'), columns=state.get('columns'),
+                      compact=state.get('compact', False))
+
+    def window(self, t1=None, t2=None, rebase=False):
+        """
+        Function to return the sub-catalog of events with t1 <= time < t2
+
+        For time-ordered catalogs the columns of the sub-catalog are views
+        of this catalog, so no event data is copied; with rebase=True only
+        the time column is copied, shifted so the window starts at 0.
+        The length is t2 - t1 and Ns is recounted on the same Mws.
+        """
+        if t1 is None:
+            t1 = 0.0
+        if t2 is None:
+            t2 = self.length
+        index = self.time_window(t1, t2)
+        columns = dict((name, self._columns[name][index])
+                       for name in catalog_fields)
+        if rebase:
+            columns['time'] = columns['time'] - t1
+        sub = Catalog(columns=columns, length=t2 - t1, max_dep=self.max_dep,
+                      Mws=self.Mws, seed=self.seed, compact=self.compact)
+        sub._count_Ns()
+        return sub
+
+    def cycle(self, n, period=seccycle, rebase=True):
+        """
+        Function to return the sub-catalog of tidal cycle n (counting from
+        0), with times rebased to the start of the cycle by default
+        """
+        return self.window(n*period, (n + 1)*period, rebase=rebase)
+
+    def split_cycles(self, period=seccycle, rebase=True):
+        """
+        Function to split the catalog into a list of per-cycle sub-catalogs
+        (see cycle).  A last partial cycle is kept, with a shorter length.
+        """
+        ncycles = int(math.ceil(self.length/period))
+        return [self.window(n*period, min((n + 1)*period, self.length),
+                            rebase=rebase)
+                for n in range(ncycles)]
+
+    def _count_Ns(self):
+        if self.Mws is not None:
+            self.Ns = np.array(self.cumulative_counts(self.Mws))
+
+    def cumulative_counts(self, Mws=None):
+        """
+        Function to count the events with magnitude greater than or equal
+        to each value in Mws (defaults to self.Mws)
+
+        Uses the magnitude-sorted index, so any Mw grid costs one binary
+        search per grid point
+        """
+        if Mws is None:
+            Mws = self.Mws
+        Mws = np.asarray(Mws, dtype=np.float64)
+
+        def counts():
+            mags = self._magnitude_index()[1]
+            return (len(mags) -
+                    np.searchsorted(mags, Mws, side='left')).astype(float)
+
+        return self._memoize(('counts', Mws.tobytes()), counts)
+
+    def b_value(self, Mc=None):
+        """
+        Function to estimate the G-R b-value by maximum likelihood
+
+        Uses the Aki (1965) estimator for continuous magnitudes above the
+        completeness magnitude Mc (defaults to the smallest magnitude in the
+        catalog), with the Shi and Bolt (1982) uncertainty.  Note that the
+        estimate is biased high when max_m0 truncates the distribution
+        close to Mc.
+
+        Returns a tuple of b,sigma_b,n with n the number of events used
+        """
+
+        def estimate():
+            mags = self._magnitude_index()[1]
+            if Mc is None:
+                used = mags
+                mc = mags[0] if len(mags) else np.nan
+            else:
+                used = mags[np.searchsorted(mags, Mc, side='left'):]
+                mc = Mc
+            n = len(used)
+            if n < 2:
+                return (np.nan, np.nan, n)
+            mean = used.mean(dtype=np.float64)
+            b = math.log10(math.e)/(mean - mc)
+            sigma = 2.3*b*b*math.sqrt(np.sum((used - mean)**2)/(n*(n - 1)))
+            return (b, sigma, n)
+
+        return self._memoize(('b_value', Mc), estimate)
+
+    def moment(self, min_Mw=None):
+        """
+        Function to return the total seismic moment (in Nm) of the catalog,
+        optionally only for events with magnitude of at least min_Mw
+        """
+
+        def total():
+            if min_Mw is None:
+                mags = self._columns['magnitude']
+            else:
+                mags = self._columns['magnitude'][self.magnitude_above(min_Mw)]
+            return float(np.sum(calc_m0(mags.astype(np.float64))))
+
+        return self._memoize(('moment', min_Mw), total)
+
+    def moment_per_cycle(self, period=seccycle):
+        """
+        Function to return the seismic moment (in Nm) released in each
+        period (defaults to one Titan tidal cycle) of the catalog
+        """
+
+        def per_cycle():
+            ncycles = int(math.ceil(self.length/period))
+            cycle = (self._columns['time']//period).astype(int)
+            m0 = calc_m0(self._columns['magnitude'].astype(np.float64))
+            return np.bincount(cycle, weights=m0, minlength=ncycles)
+
+        return self._memoize(('moment_per_cycle', period, self.length),
+                             per_cycle)
+
+    def rate(self, bin_length=secday, min_Mw=None):
+        """
+        Function to return the number of events per bin_length seconds
+
+        Returns a tuple of times,counts with times the start of each bin
+        """
+
+        def series():
+            nbins = int(math.ceil(self.length/bin_length))
+            if min_Mw is None:
+                time = self._columns['time']
+            else:
+                time = self._columns['time'][self.magnitude_above(min_Mw)]
+            counts = np.bincount((time//bin_length).astype(int),
+                                 minlength=nbins)
+            times = np.arange(len(counts))*bin_length
+            return (times, counts)
+
+        return self._memoize(('rate', bin_length, min_Mw, self.length),
+                             series)
+
+
+def concatenate_catalogs(catalogs, offsets=None):
+    """
+    Function to join several catalogs into one
+
+    offsets are the start times of each catalog in the joined catalog and
+    default to stitching them end to end.  Events are kept in time order
+    if the offset catalogs overlap, the length covers the end of the last
+    catalog and Ns is recounted on the Mws of the first catalog.
+    """
+    if offsets is None:
+        offsets = np.concatenate([[0.0], np.cumsum([catalog.length for catalog
+                                                    in catalogs])[:-1]])
+    compact = all(catalog.compact for catalog in catalogs)
+    columns = {}
+    for name in catalog_fields:
+        if name == 'time':
+            columns[name] = np.concatenate([catalog.time + offset
+                                            for (catalog, offset)
+                                            in zip(catalogs, offsets)])
+        else:
+            columns[name] = np.concatenate([getattr(catalog, name)
+                                            for catalog in catalogs])
+    time = columns['time']
+    if np.any(time[1:] < time[:-1]):
+        order = np.argsort(time, kind='stable')
+        columns = dict((name, column[order])
+                       for (name, column) in columns.items())
+    length = max(offset + catalog.length for (catalog, offset)
+                 in zip(catalogs, offsets))
+    max_deps = [catalog.max_dep for catalog in catalogs
+                if catalog.max_dep is not None]
+    joined = Catalog(columns=columns, length=length,
+                     max_dep=max(max_deps) if max_deps else None,
+                     Mws=catalogs[0].Mws, compact=compact)
+    joined._count_Ns()
+    return joined
+
+
+class CatalogStream(object):
+    """
+    An iterator over time-ordered blocks of events generated from a
+    GutenbergRichter object
+    """
+
+    def __init__(self, gr_obj, length, block_length=secday, max_dep=None,
+                 Mws=None, Msamp=None, seed=None, modulation=None,
+                 period=seccycle, modulation_max=None, binned=False,
+                 location=None, depth=None, mechanism=None):
+        """
+        Set up a stream of events covering length seconds
+
+        block_length is the duration of each yielded block in seconds.
+        The random number generator, the current time and the running Ns
+        are all part of the stream state (see get_state), so a stream can
+        be stopped after any block and resumed with from_state.
+
+        modulation, if given, is a function of phase (0 to 1 within each
+        period seconds, one Titan tidal cycle by default) returning the
+        relative seismicity rate, which is applied by thinning (see
+        _draw_events).  A modulation with a mean of 1 over the cycle keeps
+        the long-term rate of the G-R relationship.  modulation_max is an
+        upper bound of the modulation; if not given, modulation.max is
+        used when it exists, otherwise the maximum over 10001 phases.
+
+        Magnitudes are drawn from the continuous G-R distribution truncated
+        between min_m0 and max_m0 (see GutenbergRichter.sample_moments).
+        If min_m0 is not set, the lowest Mws bin (Mw 0 by default) is the
+        lower bound, as in the original scheme.  binned=True instead uses
+        the original scheme, which picks one of the Mws bins and adds a
+        uniform offset of up to Msamp, and so can exceed max_m0 by up to
+        one bin.
+
+        location, depth and mechanism are the distributions the source
+        locations, depths and focal mechanisms are drawn from (see
+        sourcemodels).  They default to epicenters uniform over the sphere,
+        depths uniform between 0 and max_dep and random mechanisms.  Like
+        modulation they are not part of the stream state.
+        """
+
+        (self.Mws, self.Msamp) = gr_obj._get_Mws(Mws, Msamp)
+        if max_dep is None:
+            max_dep = getattr(depth, 'max_dep', 10.0)
+        self.max_dep = max_dep
+        if location is None:
+            location = sourcemodels.UniformSphere()
+        if depth is None:
+            depth = sourcemodels.UniformDepth(max_dep)
+        if mechanism is None:
+            mechanism = sourcemodels.UniformMechanism()
+        self.location = location
+        self.depth = depth
+        self.mechanism = mechanism
+        self.length = length
+        self.block_length = max(int(block_length), 1)
+        self.time = 0
+        self.Ns = np.zeros_like(self.Mws)
+        self.binned = binned
+        if binned:
+            self.Nsec = gr_obj.get_N(self.Mws)/secyear
+            self.rate = self.Nsec[0]
+        else:
+            self.gr_obj = gr_obj
+            if gr_obj.min_m0 is None:
+                self.min_m0 = float(calc_m0(self.Mws[0]))
+            else:
+                self.min_m0 = gr_obj.min_m0
+            self.rate = gr_obj.expected_count(1.0, min_m0=self.min_m0)
+        self.rng = np.random.default_rng(seed)
+        self.modulation = modulation
+        self.period = period
+        if modulation is not None and modulation_max is None:
+            modulation_max = getattr(modulation, 'max', None)
+            if modulation_max is None:
+                modulation_max = float(np.max(
+                    modulation(np.linspace(0.0, 1.0, 10001))))
+        self.modulation_max = modulation_max
+
+    def __iter__(self):
+        return self
+
+    def _draw_magnitudes(self, n, rng):
+        if not self.binned:
+            return self.gr_obj.sample_magnitudes(n, rng, min_m0=self.min_m0)
+        # Nsec decreases with Mw, so the number of bins with Nsec > ran
+        # gives the largest bin exceeded
+        ran = rng.random(n)*min(self.Nsec[0], 1.0)
+        index = np.searchsorted(-self.Nsec, -ran, side='left') - 1
+        return self.Mws[index] + rng.random(n)*self.Msamp
+
+    def __next__(self):
+        nsec = min(self.block_length, int(self.length) - self.time)
+        if nsec <= 0:
+            raise StopIteration
+        (block, Ns) = _draw_events(self.rng, float(self.time), nsec,
+                                   self.rate, self._draw_magnitudes,
+                                   self.Mws, self.location, self.depth,
+                                   self.mechanism,
+                                   modulation=self.modulation,
+                                   period=self.period,
+                                   modulation_max=self.modulation_max)
+        self.time += nsec
+        self.Ns = self.Ns + Ns
+        return block
+
+    next = __next__
+
+    def get_state(self):
+        """
+        Function to return the stream state as a JSON-serializable dict
+        """
+        return {'length': self.length, 'block_length': self.block_length,
+                'max_dep': self.max_dep, 'Msamp': self.Msamp,
+                'Mws': self.Mws.tolist(), 'time': self.time,
+                'Ns': self.Ns.tolist(), 'rng': self.rng.bit_generator.state,
+                'modulated': self.modulation is not None,
+                'binned': self.binned,
+                'period': self.period, 'modulation_max': self.modulation_max}
+
+    def set_state(self, state):
+        """
+        Function to restore a stream state returned by get_state
+        """
+        self.length = state['length']
+        self.block_length = state['block_length']
+        self.max_dep = state['max_dep']
+        self.Msamp = state['Msamp']
+        self.time = state['time']
+        self.Ns = np.array(state['Ns'])
+        bit_generator = getattr(np.random, state['rng']['bit_generator'])()
+        bit_generator.state = state['rng']
+        self.rng = np.random.Generator(bit_generator)
+        if not np.allclose(self.Mws, state['Mws']):
+            raise ValueError("stream state does not match the Mws bins")
+        if state.get('modulated', False) != (self.modulation is not None):
+            raise ValueError("stream state and modulation do not match")
+        if state.get('binned', False) != self.binned:
+            raise ValueError("stream state and magnitude sampling do not "
+                             "match")
+        self.period = state.get('period', seccycle)
+        self.modulation_max = state.get('modulation_max')
+
+    def save_state(self, filename):
+        """
+        Function to write the stream state to a json file
+
+        The file is replaced atomically, so an interruption never leaves a
+        partially written state behind
+        """
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.get_state(), f)
+        os.replace(tmpname, filename)
+
+    @classmethod
+    def from_state(cls, gr_obj, state, modulation=None, location=None,
+                   depth=None, mechanism=None):
+        """
+        Function to resume a stream from a state dict or a json state file
+        written by save_state
+
+        Modulation functions and source distributions are not part of the
+        state, so a stream must be resumed with the same ones
+        """
+        if not isinstance(state, dict):
+            with open(state, 'r') as f:
+                state = json.load(f)
+        stream = cls(gr_obj, state['length'],
+                     block_length=state['block_length'],
+                     max_dep=state['max_dep'], Mws=np.array(state['Mws']),
+                     Msamp=state['Msamp'], modulation=modulation,
+                     period=state.get('period', seccycle),
+                     modulation_max=state.get('modulation_max'),
+                     binned=state.get('binned', False), location=location,
+                     depth=depth, mechanism=mechanism)
+        stream.set_state(state)
+        return stream
+
+
+class TidalModulation(object):
+    """
+    A cosine modulation of the seismicity rate over the tidal cycle
+
+    rate(phase) = 1 + amplitude*cos(2 pi (phase - peak_phase))
+
+    which has a mean of 1 over the cycle, so it redistributes events within
+    each cycle without changing the long-term rate.  Unlike a lambda, it
+    can be pickled and passed to generate_ensemble.
+    """
+
+    def __init__(self, amplitude=0.5, peak_phase=0.0):
+        if (amplitude < 0.0) or (amplitude > 1.0):
+            raise ValueError("amplitude must be between 0 and 1")
+        self.amplitude = amplitude
+        self.peak_phase = peak_phase
+        self.max = 1.0 + amplitude
+
+    def __call__(self, phase):
+        return 1.0 + self.amplitude*np.cos(2.0*np.pi*(phase - self.peak_phase))
+
+
+class Aftershocks(object):
+    """
+    Parameters of ETAS-style aftershock clustering
+
+    Every event, background or triggered, produces a Poisson number of
+    direct aftershocks with mean K*10^(alpha*(Mw - Mmin)), with Mmin the
+    magnitude of min_m0.  K is chosen so that the mean over the G-R
+    magnitude distribution is the branching ratio, which must be below 1
+    for the sequences to die out.  Aftershock delays follow the Omori-Utsu
+    law, with a density proportional to (t + c)^(-p) for t > 0 (c in s,
+    p > 1), epicenters are uniform within radius deg of the parent and
+    magnitudes, depths and mechanisms are drawn as for background events.
+
+    Aftershocks falling after the end of the catalog are dropped, and
+    there are no aftershocks of events before its start, so a catalog
+    holds fewer events per background event than in a steady state,
+    increasingly so as p gets close to 1 or the catalog gets shorter (see
+    family_size).
+
+    Each generation of aftershocks is drawn in one batch, so the cost
+    grows with the number of generations rather than the number of
+    events.  Like TidalModulation, it can be passed to generate_ensemble.
+    """
+
+    def __init__(self, branching=0.5, alpha=0.8, c=60.0, p=1.2, radius=0.5):
+        if (branching < 0.0) or (branching >= 1.0):
+            raise ValueError("branching ratio must be between 0 and 1")
+        if p <= 1.0:
+            raise ValueError("p must be greater than 1")
+        if c <= 0.0:
+            raise ValueError("c must be positive")
+        self.branching = branching
+        self.alpha = alpha
+        self.c = c
+        self.p = p
+        self.radius = radius
+
+    def productivity(self, gr_obj):
+        """
+        Function to return K for the magnitude distribution of gr_obj
+
+        Uses the mean of (m0/min_m0)^(alpha/1.5) over the truncated
+        distribution N = mA m0^(-mB)
+        """
+        if gr_obj.min_m0 is None:
+            raise ValueError("min_m0 must be set")
+        mB = 2.0*gr_obj.b/3.0
+        g = self.alpha/1.5
+        if gr_obj.max_m0 is None:
+            if g >= mB:
+                raise ValueError("alpha must be below b without max_m0")
+            mean = mB/(mB - g)
+        else:
+            r = gr_obj.max_m0/gr_obj.min_m0
+            if np.isclose(g, mB):
+                mean = mB*math.log(r)/(1.0 - r**(-mB))
+            else:
+                mean = mB*(r**(g - mB) - 1.0)/((g - mB)*(1.0 - r**(-mB)))
+        return self.branching/mean
+
+    def delays(self, n, rng):
+        """
+        Function to draw n aftershock delays (s) from the Omori-Utsu law
+        """
+        return self.c*(np.power(1.0 - rng.random(n),
+                                -1.0/(self.p - 1.0)) - 1.0)
+
+    def family_size(self, length, nsamples=10000, tol=1e-6, seed=0):
+        """
+        Function to return the expected number of events in a catalog of
+        length seconds per background event, counting the event itself and
+        all its aftershocks before the end of the catalog
+
+        This is 1/(1 - branching) for an infinitely long catalog.  Each
+        generation has branching times as many events as the previous one,
+        so the result is the sum over generations k of branching^k times
+        the probability that k successive delays fit between a uniformly
+        distributed background time and length, which is estimated from
+        nsamples draws of a generator seeded with seed (so the result is
+        repeatable).  Generations are added until branching^k is below
+        tol.
+        """
+        rng = np.random.default_rng(seed)
+        left = length*rng.random(nsamples)
+        total = 1.0
+        weight = 1.0
+        while True:
+            weight *= self.branching
+            if (weight < tol) or not np.any(left > 0.0):
+                break
+            left -= self.delays(nsamples, rng)
+            total += weight*np.mean(left > 0.0)
+        return total
+
+    def trigger(self, parents, gr_obj, length, rng, magnitudes, depth,
+                mechanism):
+        """
+        Function to draw all aftershocks of the parents catalog array,
+        generation by generation, keeping those before length seconds
+
+        magnitudes(n, rng), depth and mechanism draw the source attributes,
+        as in _draw_events
+
+        Returns an (nevents, 8) array laid out as in catalog_ids, not
+        sorted in time
+        """
+        K = self.productivity(gr_obj)
+        Mmin = calc_Mw(gr_obj.min_m0)
+        generations = [np.empty((0, len(catalog_ids)))]
+        while len(parents):
+            counts = rng.poisson(K*np.power(10.0, self.alpha*(parents[:, 1] -
+                                                              Mmin)))
+            index = np.repeat(np.arange(len(parents)), counts)
+            time = parents[index, 0] + self.delays(len(index), rng)
+            index = index[time < length]
+            time = time[time < length]
+            nevents = len(index)
+
+            children = np.empty((nevents, len(catalog_ids)))
+            children[:, 0] = time
+            children[:, 1] = magnitudes(nevents, rng)
+            (children[:, 2], children[:, 3]) = sourcemodels.sample_cap(
+                parents[index, 2], parents[index, 3], self.radius, nevents,
+                rng)
+            children[:, 4] = depth.sample(nevents, rng)
+            (children[:, 5], children[:, 6],
+             children[:, 7]) = mechanism.sample(nevents, rng)
+            generations.append(children)
+            parents = children
+        return np.concatenate(generations)
+
 
 class GutenbergRichter(object):
     """
@@ -84,10 +841,10 @@ class GutenbergRichter(object):
         """
         if (self.b is None) or (self.m0total is None) or (self.max_m0 is None):
             raise ValueError("b, m0total, and max_m0 must be set")
-        self.mB = 2.0*self.b/3.0
-        self.mA = (1.0 - self.mB) * self.m0total/(self.mB * 
-                                                  self.max_m0**(1.0 - self.mB))
-        self.a = math.log10(self.mA) - 9.1*self.mB
+        (a, mA, mB) = calc_a_array(self.b, self.m0total, self.max_m0)
+        self.mB = float(mB)
+        self.mA = float(mA)
+        self.a = float(a)
 
     def calc_m0total(self):
         """
@@ -95,10 +852,10 @@ class GutenbergRichter(object):
         """
         if (self.a is None) or (self.b is None) or (self.max_m0 is None):
             raise ValueError("a, b, and max_m0 must be set")
-        self.mB = 2.0*self.b/3.0
-        self.mA = math.pow(10.0, (self.a + 9.1*self.mB))
-        self.m0total = ((self.mA*self.mB/(1.0 - self.mB))*
-                        self.max_m0**(1.0 - self.mB))
+        (m0total, mA, mB) = calc_m0total_array(self.a, self.b, self.max_m0)
+        self.mB = float(mB)
+        self.mA = float(mA)
+        self.m0total = float(m0total)
 
     def get_N(self, Mw):
         """
@@ -111,22 +868,165 @@ class GutenbergRichter(object):
         N = np.power(10.0, (self.a - self.b*Mw))
         return N
 
-    def generate_catalog(self, length, max_dep=None, Mws=None, Msamp=None):
+    def expected_count(self, length, min_m0=None):
+        """
+        Function to return the expected number of events with moment
+        between min_m0 (defaults to self.min_m0) and max_m0 in length
+        seconds
+        """
+        if min_m0 is None:
+            min_m0 = self.min_m0
+        if min_m0 is None:
+            raise ValueError("min_m0 must be set")
+        N = float(self.get_N(calc_Mw(min_m0)))
+        if self.max_m0 is not None:
+            N -= float(self.get_N(calc_Mw(self.max_m0)))
+        return N*length/secyear
+
+    def sample_moments(self, n, rng=None, min_m0=None):
+        """
+        Function to draw n seismic moments (in Nm) from the G-R distribution
+        truncated between min_m0 (defaults to self.min_m0) and max_m0
+
+        Inverts the cumulative distribution of N = mA m0^(-mB) directly, so
+        the result is exact at both bounds.  rng is anything accepted by
+        np.random.default_rng.  If max_m0 is not set, the distribution is
+        only truncated below.
+        """
+        if min_m0 is None:
+            min_m0 = self.min_m0
+        if (self.b is None) or (min_m0 is None):
+            raise ValueError("b and min_m0 must be set")
+        rng = np.random.default_rng(rng)
+        mB = 2.0*self.b/3.0
+        lower = min_m0**(-mB)
+        if self.max_m0 is None:
+            upper = 0.0
+        else:
+            upper = self.max_m0**(-mB)
+        u = rng.random(n)
+        return np.power(lower - u*(lower - upper), -1.0/mB)
+
+    def sample_magnitudes(self, n, rng=None, min_m0=None):
+        """
+        Function to draw n moment magnitudes from the G-R distribution
+        truncated between min_m0 (defaults to self.min_m0) and max_m0 (see
+        sample_moments)
+        """
+        return calc_Mw(self.sample_moments(n, rng, min_m0=min_m0))
+
+    def expected_moment(self, length):
+        """
+        Function to return the expected seismic moment (in Nm) released in
+        length seconds by events between min_m0 and max_m0
+
+        Integrates the G-R moment distribution N = mA m0^(-mB) between the
+        two bounds, so it equals m0total per year when min_m0 is 0
+        """
+        if (self.a is None) or (self.b is None) or (self.max_m0 is None):
+            raise ValueError("a, b, and max_m0 must be set")
+        mB = 2.0*self.b/3.0
+        mA = math.pow(10.0, (self.a + 9.1*mB))
+        min_m0 = 0.0 if self.min_m0 is None else self.min_m0
+        m0 = (mA*mB/(1.0 - mB))*(self.max_m0**(1.0 - mB) -
+                                 min_m0**(1.0 - mB))
+        return m0*length/secyear
+
+    def generate_catalog(self, length, max_dep=None, Mws=None, Msamp=None,
+                         seed=None, compact=False, modulation=None,
+                         period=seccycle, modulation_max=None, binned=False,
+                         location=None, depth=None, mechanism=None,
+                         aftershocks=None):
         """
         Function to generate a catalog of events of a specified length in 
         seconds
 
-        Returns a tuple of catalog,Ns,Mws
+        The catalog is stored in self.catalog, a Catalog object holding
 
-        catalog: an array with 6 columns 
-         [time (s), magnitude (Mw), dist (deg), backaz (deg),
-          strike, rake, dip (all in deg)]
+        columns: time (s), magnitude (Mw), delta (deg), backaz (deg),
+         depth (km), strike, rake, dip (all in deg)
         Ns: an array of number of events greater than or equal to a given mag
         Mws: the magnitude values for Ns
+
+        seed can be anything accepted by np.random.default_rng (an integer,
+        a SeedSequence or a Generator) and makes the catalog reproducible
+        compact stores all fields except time as float32 (see Catalog)
+        modulation, period and modulation_max give an optional tidal-phase
+        modulation of the rate (see CatalogStream and TidalModulation)
+        binned selects the original binned magnitude sampling instead of
+        the exact truncated G-R distribution (see CatalogStream)
+        location, depth and mechanism are optional source distributions
+        (see sourcemodels), e.g. sourcemodels.RegionalCluster for events
+        concentrated around one region
+        aftershocks, an Aftershocks object, adds clustered sequences
+        triggered by every event.  The background rate is then divided by
+        the expected number of events per background event in a catalog of
+        this length (Aftershocks.family_size), which accounts for the
+        aftershocks dropped past its end, so the expected number of events
+        and moment release still follow the G-R relationship.  Only the
+        background events follow the modulation.
+        """
+        stream = self.stream_catalog(length, block_length=length,
+                                     max_dep=max_dep, Mws=Mws, Msamp=Msamp,
+                                     seed=seed, modulation=modulation,
+                                     period=period,
+                                     modulation_max=modulation_max,
+                                     binned=binned, location=location,
+                                     depth=depth, mechanism=mechanism)
+        if aftershocks is not None:
+            # Background events and the aftershocks kept in the catalog
+            # make up the total
+            stream.rate /= aftershocks.family_size(length)
+        blocks = list(stream)
+        if blocks:
+            catalog = np.concatenate(blocks)
+        else:
+            catalog = np.empty((0, len(catalog_ids)))
+        Ns = stream.Ns
+
+        if aftershocks is not None:
+            triggered = aftershocks.trigger(catalog, self, length, stream.rng,
+                                            stream._draw_magnitudes,
+                                            stream.depth, stream.mechanism)
+            catalog = np.concatenate([catalog, triggered])
+            catalog = catalog[np.argsort(catalog[:, 0], kind='stable')]
+            Ns = (len(catalog) -
+                  np.searchsorted(np.sort(catalog[:, 1]), stream.Mws,
+                                  side='left')).astype(float)
+
+        self.catalog = Catalog(data=catalog, length=length,
+                               max_dep=stream.max_dep, Ns=Ns,
+                               Mws=stream.Mws, compact=compact)
+
+    def stream_catalog(self, length, block_length=secday, max_dep=None,
+                       Mws=None, Msamp=None, seed=None, modulation=None,
+                       period=seccycle, modulation_max=None, binned=False,
+                       location=None, depth=None, mechanism=None):
         """
+        Function to generate a catalog of a specified length in seconds as
+        a stream of time-ordered blocks
+
+        Returns a CatalogStream, which yields arrays with the same 8 columns
+        as Catalog.data, each covering block_length seconds.  Only one block
+        is held in memory at a time, and the stream state can be saved and
+        resumed, so very long catalogs can be written out incrementally.
+        """
+        return CatalogStream(self, length, block_length=block_length,
+                             max_dep=max_dep, Mws=Mws, Msamp=Msamp, seed=seed,
+                             modulation=modulation, period=period,
+                             modulation_max=modulation_max, binned=binned,
+                             location=location, depth=depth,
+                             mechanism=mechanism)
+
+    def _get_Mws(self, Mws=None, Msamp=None):
+        """
+        Function to set up the magnitude bins used for catalog generation
+
+        Returns a tuple of Mws,Msamp
+        """
+        if Msamp is None:
+            Msamp = 0.25
         if Mws is None:
-            if Msamp is None:
-                Msamp = 0.25
             if self.max_m0 is None:
                 maxM = 9.0
             else:
@@ -138,49 +1038,63 @@ class GutenbergRichter(object):
 
             Mws = np.arange(minM, maxM + Msamp, Msamp)
 
-        if max_dep is None:
-            max_dep = 10.0
-
-        Nsec = self.get_N(Mws)/secyear
-
-        Ns = np.zeros_like(Nsec)
-        catalog = []
-        for sec in tqdm(range(0, int(length))):
-            ran = random.random()
-            mask = (Nsec > ran).astype(int)
-            if (mask.max() == 1):
-                Ns = Ns + mask
-                index=np.amax(np.where(mask == 1)[0])
-                time = sec + random.random()
-                mag = Mws[index] + random.random()*Msamp
-                theta = math.acos(random.uniform(-1.0,1.0))
-                delta = rad2deg * theta
-                backaz = random.uniform(0,360)
-                depth = random.uniform(0,max_dep)
-                strike = random.uniform(0,360)
-                rake = random.uniform(0,360)
-                dip = random.uniform(0,90)
-                catalog.append(np.array([time, mag, delta, backaz, depth, 
-                                         strike, rake, dip]))
-                
-
-        id_dict = {'time' : 0, 'magnitude' : 1, 'delta' : 2, 'backaz' : 3,
-                   'depth' : 4, 'strike' : 5, 'rake' : 6, 'dip' : 7}
-        catalog = np.array(catalog)
-        self.catalog = Catalog(data=catalog, length=length, max_dep=max_dep,
-                               Ns=Ns, Mws=Mws, id_dict=id_dict)
-
-        #return (catalog,Ns,Mws)
-
-    def write_csv(self, filename=None):
+        return (Mws, Msamp)
+
+    def save_catalog(self, dirname):
+        """
+        Function to write the G-R parameters and catalog to a catalog
+        directory (by convention named *.grcat)
+
+        The directory holds header.json, with the format version, the G-R
+        parameters and the catalog metadata, plus Mws.npy, Ns.npy and one
+        .npy file per event field.  The directory is written next to its
+        final location and moved into place when complete.
+        """
+        catalog = self.catalog
+        dirname = dirname.rstrip(os.sep)
+        tmpname = dirname + '.tmp'
+        if os.path.exists(tmpname):
+            shutil.rmtree(tmpname)
+        os.makedirs(tmpname)
+
+        for name in catalog_fields:
+            np.save(os.path.join(tmpname, name + '.npy'),
+                    getattr(catalog, name))
+        np.save(os.path.join(tmpname, 'Mws.npy'), np.asarray(catalog.Mws))
+        np.save(os.path.join(tmpname, 'Ns.npy'), np.asarray(catalog.Ns))
+
+        header = {'format': catalog_format,
+                  'version': catalog_format_version,
+                  'gutenbergrichter': dict((name, getattr(self, name, None))
+                                           for name in gr_params),
+                  'catalog': {'length': catalog.length,
+                              'max_dep': catalog.max_dep,
+                              'nevents': len(catalog),
+                              'compact': catalog.compact,
+                              'seed': catalog.seed,
+                              'fields': list(catalog_fields)}}
+        with open(os.path.join(tmpname, 'header.json'), 'w') as f:
+            json.dump(header, f, indent=1)
+
+        if os.path.exists(dirname):
+            shutil.rmtree(dirname)
+        os.rename(tmpname, dirname)
+
+    def write_csv(self, filename=None, chunksize=csv_chunksize):
         """
         Function to output a csv file with all catalog details
+
+        Events are formatted chunksize rows at a time, with enough digits
+        to read back the stored values exactly (see read_csv)
         """
 
         if filename is None:
             filename='gr_catalog.csv'
+        catalog = self.catalog
+        fmt = ','.join('%.17g' if getattr(catalog, name).dtype == np.float64
+                       else '%.9g' for name in catalog_fields)
         with open(filename, 'w') as f:
-            output = csv.writer(f)
+            output = csv.writer(f, lineterminator='\n')
             output.writerow(['a', 'b', 'M0 total', 'Max M0', 'Min M0',
                              'Max Depth'])
             output.writerow([str(self.a), str(self.b), str(self.m0total),
@@ -190,13 +1104,326 @@ class GutenbergRichter(object):
             output.writerow(['Magnitude and numbers stats'])
             output.writerow(self.catalog.Mws)
             output.writerow(self.catalog.Ns)
-            output.writerow(['Time', 'Mw', 'Colatitude', 'Longitude', 'Depth',
-                             'Strike', 'Rake', 'Dip'])
-            output.writerows(self.catalog.data)
-        
+            output.writerow(csv_columns)
+            for i in range(0, len(catalog), chunksize):
+                chunk = np.column_stack([getattr(catalog, name)[i:i+chunksize]
+                                         for name in catalog_fields])
+                np.savetxt(f, chunk, fmt=fmt, delimiter=',')
+
+def read_csv(filename, chunksize=csv_chunksize, seed=None, compact=False):
+    """
+    Function to read a csv file written by GutenbergRichter.write_csv
+
+    Events are parsed chunksize rows at a time.  If the event rows lack the
+    strike, rake and dip columns, random mechanisms are filled in (see
+    random_mechanisms), drawn with seed.
+
+    Returns a GutenbergRichter object with its catalog
+    """
+
+    def value(item):
+        return None if item == 'None' else float(item)
+
+    rng = np.random.default_rng(seed)
+    with open(filename, 'r') as f:
+        reader = csv.reader(f)
+        next(reader)
+        (a, b, m0total, max_m0, min_m0, max_dep) = [value(item) for item
+                                                    in next(reader)]
+        length = float(next(reader)[1])
+        next(reader)
+        Mws = np.array(next(reader), dtype=np.float64)
+        Ns = np.array(next(reader), dtype=np.float64)
+        next(reader)
+        chunks = [_complete_events(chunk, rng) for chunk
+                  in iter_csv_chunks(f, skiprows=0, chunksize=chunksize)]
+
+    gr_obj = GutenbergRichter(a=a, b=b, m0total=m0total, max_m0=max_m0,
+                              min_m0=min_m0, max_dep=max_dep)
+    if chunks:
+        data = np.concatenate(chunks)
+    else:
+        data = None
+    gr_obj.catalog = Catalog(data=data, length=length, max_dep=max_dep,
+                             Mws=Mws, Ns=Ns, compact=compact)
+    return gr_obj
+
+def iter_csv_chunks(filename, skiprows=1, chunksize=csv_chunksize,
+                    usecols=None, delimiter=','):
+    """
+    Function to read a numeric csv file in chunks of chunksize rows
+
+    filename can also be an open file.  skiprows header lines are skipped
+    first.  Yields 2-D float64 arrays, so memory use is bounded by the
+    chunk size however long the file is.
+    """
+    if isinstance(filename, str):
+        with open(filename, 'r') as f:
+            for chunk in iter_csv_chunks(f, skiprows=skiprows,
+                                         chunksize=chunksize,
+                                         usecols=usecols,
+                                         delimiter=delimiter):
+                yield chunk
+        return
+
+    lines = itertools.islice(filename, skiprows, None)
+    while True:
+        block = [line for line in itertools.islice(lines, chunksize)
+                 if line.strip()]
+        if not block:
+            return
+        yield np.loadtxt(block, delimiter=delimiter, usecols=usecols,
+                         ndmin=2)
+
+def random_mechanisms(n, rng=None):
+    """
+    Function to draw n random focal mechanisms, as used for generated
+    catalogs
+
+    Returns a tuple of strike,rake,dip arrays (all in deg)
+    """
+    rng = np.random.default_rng(rng)
+    return sourcemodels.UniformMechanism().sample(n, rng)
+
+def _complete_events(chunk, rng):
+    """
+    Function to fill in random strike, rake and dip for event rows that
+    only hold the first five columns
+    """
+    if chunk.shape[1] >= len(catalog_fields):
+        return chunk
+    (strike, rake, dip) = random_mechanisms(len(chunk), rng)
+    return np.column_stack([chunk[:, :5], strike, rake, dip])
+
+def load_catalog(filename, mmap=True):
+    """
+    Function to read a GutenbergRichter object with its catalog
+
+    filename is either a catalog directory written by save_catalog or a
+    catalog pickle file.  Columns of catalog directories are memory-mapped
+    read-only unless mmap is False, so opening is instant and processes
+    reading the same catalog share pages.
+    """
+    if not os.path.isdir(filename):
+        with open(filename, 'rb') as f:
+            if sys.version_info > (3,0):
+                return pickle.load(f, encoding='latin1')
+            return pickle.load(f)
+
+    with open(os.path.join(filename, 'header.json'), 'r') as f:
+        header = json.load(f)
+    if header.get('format') != catalog_format:
+        raise ValueError("%s is not a catalog directory" % filename)
+    if header['version'] > catalog_format_version:
+        raise ValueError("%s has catalog format version %d, only versions "
+                         "up to %d are supported" %
+                         (filename, header['version'],
+                          catalog_format_version))
+
+    mmap_mode = 'r' if mmap else None
+    gr_obj = GutenbergRichter()
+    for (name, value) in header['gutenbergrichter'].items():
+        if value is not None:
+            setattr(gr_obj, name, value)
+    meta = header['catalog']
+    columns = dict((name, np.load(os.path.join(filename, name + '.npy'),
+                                  mmap_mode=mmap_mode))
+                   for name in meta['fields'])
+    seed = meta['seed']
+    if seed is not None:
+        seed = tuple(seed)
+    gr_obj.catalog = Catalog(columns=columns, length=meta['length'],
+                             max_dep=meta['max_dep'],
+                             Mws=np.load(os.path.join(filename, 'Mws.npy')),
+                             Ns=np.load(os.path.join(filename, 'Ns.npy')),
+                             seed=seed, compact=meta['compact'])
+    return gr_obj
+
+def ensemble_seed(seed, realization):
+    """
+    Function to return the SeedSequence of one member of an ensemble
+
+    This is identical to the child spawned for that realization by
+    generate_ensemble, so any member can be regenerated on its own
+    """
+    return np.random.SeedSequence(seed, spawn_key=(realization,))
+
+def generate_ensemble(gr_obj, length, nreal, fileout_fmt, seed=None,
+                      max_dep=None, processes=None, **kwargs):
+    """
+    Function to generate an ensemble of independent catalogs in parallel
+
+    Each of the nreal realizations is generated from a stream spawned from
+    the master seed, pickled to fileout_fmt % realization and tagged with
+    its seed in catalog.seed.  processes is the number of worker
+    processes (defaults to the number of cores).  Any other keyword
+    arguments (e.g. modulation or location) are passed on to
+    generate_catalog and must be picklable, so module-level classes such
+    as TidalModulation or those in sourcemodels rather than lambdas.
+
+    Returns a tuple of seed,members with seed the master seed entropy and
+    members a list of (realization, filename, nevents, moment) tuples
+    """
+    return generate_sweep([gr_obj]*nreal, length,
+                          [fileout_fmt % i for i in range(nreal)], seed=seed,
+                          max_deps=[max_dep]*nreal, processes=processes,
+                          **kwargs)
+
+def generate_sweep(gr_objs, length, filenames, seed=None, max_deps=None,
+                   processes=None, **kwargs):
+    """
+    Function to generate one catalog per GutenbergRichter object in
+    parallel, e.g. over a grid of G-R parameters
+
+    Catalog i is written to filenames[i] with maximum depth max_deps[i],
+    and is generated from the stream spawned for realization i of the
+    master seed, as in generate_ensemble.  Other keyword arguments are
+    passed on to generate_catalog for every catalog.
+
+    Returns a tuple of seed,members with seed the master seed entropy and
+    members a list of (realization, filename, nevents, moment) tuples
+    """
+    if max_deps is None:
+        max_deps = [None]*len(gr_objs)
+    master = np.random.SeedSequence(seed)
+    jobs = [(gr_obj, length, max_dep, kwargs, master.entropy, i, filename)
+            for (i, (gr_obj, max_dep, filename))
+            in enumerate(zip(gr_objs, max_deps, filenames))]
+    pool = multiprocessing.Pool(processes)
+    try:
+        members = pool.map(_ensemble_member, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    return (master.entropy, members)
+
+def _ensemble_member(job):
+    """
+    Function to generate and write one member of an ensemble
+    """
+    (gr_obj, length, max_dep, kwargs, seed, realization, filename) = job
+    gr_obj = copy.copy(gr_obj)
+    gr_obj.generate_catalog(length, max_dep=max_dep,
+                            seed=ensemble_seed(seed, realization), **kwargs)
+    gr_obj.catalog.seed = (seed, realization)
+    with open(filename, 'wb') as f:
+        pickle.dump(gr_obj, f, -1)
+    return (realization, filename, len(gr_obj.catalog),
+            gr_obj.catalog.moment())
+
+def _draw_events(rng, t0, nsec, rate, magnitudes, Mws, location, depth,
+                 mechanism, modulation=None, period=seccycle,
+                 modulation_max=1.0):
+    """
+    Function to draw all events for nsec whole seconds starting at time t0
+
+    Statistically equivalent to stepping through every second: each second
+    holds at most one event, with probability rate (clipped at 1).  The
+    number of events is therefore binomial, and distinct seconds are
+    picked for them.  magnitudes(n, rng) then draws the magnitudes, and the
+    location, depth and mechanism distributions (see sourcemodels) draw
+    the other source attributes in bulk.
+
+    With a rate modulation, candidate events are drawn at the maximum
+    modulated rate and each is kept with probability
+    modulation(phase)/modulation_max (thinning), which costs no more than
+    an unmodulated catalog at the peak rate.  As in the unmodulated case,
+    the peak rate is clipped at one event per second.
+
+    Returns a tuple of catalog,Ns with catalog an (nevents, 8) array laid
+    out as in catalog_ids, and Ns the number of events greater than or
+    equal to each of Mws
+    """
+    if modulation is None:
+        pmax = min(rate, 1.0)
+    else:
+        pmax = min(rate*modulation_max, 1.0)
+    nevents = rng.binomial(nsec, pmax)
+    secs = np.sort(rng.choice(nsec, size=nevents, replace=False))
+    time = t0 + secs + rng.random(nevents)
+    if modulation is not None:
+        phase = np.mod(time/period, 1.0)
+        keep = rng.random(nevents)*modulation_max < modulation(phase)
+        time = time[keep]
+        nevents = len(time)
+
+    catalog = np.empty((nevents, len(catalog_ids)))
+    catalog[:, 0] = time
+    catalog[:, 1] = magnitudes(nevents, rng)
+    (catalog[:, 2], catalog[:, 3]) = location.sample(nevents, rng)
+    catalog[:, 4] = depth.sample(nevents, rng)
+    (catalog[:, 5], catalog[:, 6], catalog[:, 7]) = mechanism.sample(nevents,
+                                                                     rng)
+
+    Ns = nevents - np.searchsorted(np.sort(catalog[:, 1]), Mws, side='left')
+
+    return (catalog, Ns.astype(float))
+
+def calc_a_array(b, m0total, max_m0):
+    """
+    Function to determine a for arrays of G-R parameters
+
+    Same calculation as GutenbergRichter.calc_a, with b, m0total and
+    max_m0 broadcast against each other
+
+    Returns a tuple of a,mA,mB
+    """
+    b = np.asarray(b, dtype=np.float64)
+    mB = 2.0*b/3.0
+    mA = (1.0 - mB)*m0total/(mB*np.power(max_m0, 1.0 - mB))
+    a = np.log10(mA) - 9.1*mB
+    return (a, mA, mB)
+
+def calc_m0total_array(a, b, max_m0):
+    """
+    Function to determine the total moment release for arrays of G-R
+    parameters
+
+    Same calculation as GutenbergRichter.calc_m0total, with a, b and max_m0
+    broadcast against each other
+
+    Returns a tuple of m0total,mA,mB
+    """
+    b = np.asarray(b, dtype=np.float64)
+    mB = 2.0*b/3.0
+    mA = np.power(10.0, a + 9.1*mB)
+    m0total = (mA*mB/(1.0 - mB))*np.power(max_m0, 1.0 - mB)
+    return (m0total, mA, mB)
+
+def get_N_array(a, b, Mws):
+    """
+    Function to retrieve N(Mw) curves for arrays of G-R parameters
+
+    a and b are broadcast against each other, and the returned array has
+    their broadcast shape plus a last axis over Mws
+    """
+    a = np.asarray(a, dtype=np.float64)[..., np.newaxis]
+    b = np.asarray(b, dtype=np.float64)[..., np.newaxis]
+    return np.power(10.0, a - b*np.asarray(Mws))
+
+def evaluate_models(b, m0total, max_m0, min_m0, Mws):
+    """
+    Function to evaluate many G-R models in one broadcast call
+
+    b, m0total, max_m0 and min_m0 can be scalars or arrays of any shapes
+    that broadcast together, e.g. to sweep a grid of models or draw the
+    uncertainty envelope of a catalog
+
+    Returns a tuple of a,rate,Ns with rate the number of events per year
+    above min_m0 and Ns the N(Mw) curves (per year) on Mws, with a last
+    axis over Mws
+    """
+    (a, mA, mB) = calc_a_array(b, m0total, max_m0)
+    (a, b, min_m0) = np.broadcast_arrays(a, b, min_m0)
+    rate = np.power(10.0, a - b*calc_Mw(min_m0))
+    Ns = get_N_array(a, b, Mws)
+    return (a, rate, Ns)
+
 def calc_m0(Mw):
     """
     Function to calculate seismic moment (in Nm) from a moment magnitude
+
+    Mw can be a single value or an np array
     """
 
     m0 = 10.0**(1.5*Mw + 9.1)
@@ -205,8 +1432,10 @@ def calc_m0(Mw):
 def calc_Mw(m0):
     """
     Function to calculate moment magnitude from a moment given in Nm
+
+    m0 can be a single value or an np array
     """
 
-    Mw = 2.0*(math.log10(m0) - 9.1)/3.0
+    Mw = 2.0*(np.log10(m0) - 9.1)/3.0
     return Mw
     
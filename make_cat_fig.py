@@ -12,12 +12,6 @@ import matplotlib.pyplot as plt
 import pylab as P
 from tqdm import tqdm
 import sys
-python3 = sys.version_info > (3,0)
-if python3:
-    import pickle
-else:
-    import cPickle as pickle
-import sys
 
 # Determine if the output filename is specified on command line
 if len(sys.argv) > 1:
@@ -43,8 +37,7 @@ seccycle = TCycleHrs*3600.0
 # catlength = 10.0*TCycleYrs*secyear
 
 # Read catalog and get basic statistics
-with open(filein, 'rb') as f:
-    gr_obj = pickle.load(f)
+gr_obj = gr.load_catalog(filein)
 
 catlength = gr_obj.catalog.length
 ndays = int(catlength/secday)
@@ -62,34 +55,21 @@ m0total_lower = m0total*0.1
 max_m0_upper = max_m0*10.0
 max_m0_lower = max_m0*0.1
 
-# Define the Gutenberg-Richter relationship values for uncertainty estimates
-# gr_obj = gr.GutenbergRichter(b=slope, m0total=m0total, max_m0=max_m0,
-#                              min_m0=min_m0)
-# gr_obj.calc_a()
-
-gr_obj_upper1 = gr.GutenbergRichter(b=slope, m0total=m0total_upper,
-                                   max_m0=max_m0, min_m0=min_m0)
-gr_obj_upper1.calc_a()
-gr_obj_upper2 = gr.GutenbergRichter(b=slope, m0total=m0total_upper,
-                                   max_m0=max_m0_lower, min_m0=min_m0)
-gr_obj_upper2.calc_a()
-gr_obj_lower1 = gr.GutenbergRichter(b=slope, m0total=m0total_lower,
-                                   max_m0=max_m0, min_m0=min_m0)
-gr_obj_lower1.calc_a()
-gr_obj_lower2 = gr.GutenbergRichter(b=slope, m0total=m0total_lower,
-                                   max_m0=max_m0_upper, min_m0=min_m0)
-gr_obj_lower2.calc_a()
-
 # Make a plot of the chosen G-R relationship
 maxM = gr.calc_Mw(max_m0)
 minM = gr.calc_Mw(min_m0)
 Msamp = 0.25
 Mws = np.arange(minM, maxM + Msamp, Msamp)
 Ns = gr_obj.get_N(Mws)
-Ns_upper1 = gr_obj_upper1.get_N(Mws)
-Ns_upper2 = gr_obj_upper2.get_N(Mws)
-Ns_lower1 = gr_obj_lower1.get_N(Mws)
-Ns_lower2 = gr_obj_lower2.get_N(Mws)
+
+# Evaluate the G-R relationships for uncertainty estimates in one call:
+# upper1, upper2, lower1, lower2
+m0totals = np.array([m0total_upper, m0total_upper, m0total_lower,
+                     m0total_lower])
+max_m0s = np.array([max_m0, max_m0_lower, max_m0, max_m0_upper])
+(a_bounds, rate_bounds, Ns_bounds) = gr.evaluate_models(slope, m0totals,
+                                                        max_m0s, min_m0, Mws)
+(Ns_upper1, Ns_upper2, Ns_lower1, Ns_lower2) = Ns_bounds
 # max_dep = 2.0 #max depth in km, events will be uniform between 0 and max_dep
 
 # Convert Ns to be for catalog duration
@@ -115,15 +95,6 @@ Nsec = Ns/secyear
 # gr_obj.generate_catalog(catlength, max_dep=max_dep)
 
 # Plot it all up
-try:
-    time_id = gr_obj.catalog.id_dict['time']
-    mag_id = gr_obj.catalog.id_dict['magnitude']
-    delta_id = gr_obj.catalog.id_dict['delta']
-except AttributeError:
-    time_id = 0
-    mag_id = 1
-    delta_id = 2
-
 plt.figure(figsize=(10,15))
 plt.subplot(2, 1, 1)
 plt.semilogy(Mws, Ns, color="blue", linestyle="solid")
@@ -142,8 +113,8 @@ plt.ylabel("N")
 
 ndays = int(catlength/secday)
 plt.subplot(2, 1, 2)
-plt.scatter(gr_obj.catalog.data[:,time_id]/secday,
-            gr_obj.catalog.data[:,mag_id], facecolor='darkgreen')
+plt.scatter(gr_obj.catalog.time/secday,
+            gr_obj.catalog.magnitude, facecolor='darkgreen')
 plt.title("%d day (%d tidal cycles) catalog" % (ndays, ncycles))
 plt.xlabel("Day")
 plt.ylabel("Magnitude")
@@ -152,7 +123,7 @@ plt.ylim([0, 6])
 
 # plt.subplot(3, 1, 3)
 # numBins = 30
-# plt.hist(gr_obj.catalog.data[:,delta_id],numBins,color='green')
+# plt.hist(gr_obj.catalog.delta,numBins,color='green')
 # plt.title("Distances")
 # plt.xlabel("Distance (degrees)")
 # plt.ylabel("Frequency")
@@ -1,10 +1,6 @@
 #!/bin/bash
 
+# Generates catalogs/Titan_cycle_0.pkl ... Titan_cycle_9.pkl in parallel.
+# Pass -s SEED to reproduce a previous ensemble (see Titan_cycle_seeds.csv)
 source activate obspy
-COUNTER=0
-while [ $COUNTER -lt 10 ]; do
-    filename=catalogs/Titan_cycle_${COUNTER}.pkl
-    echo Working on $filename
-    python generate_catalog_titan.py $filename
-    let COUNTER=COUNTER+1
-done
+python generate_ensemble_titan.py -n 10 "$@" catalogs/Titan_cycle
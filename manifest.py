@@ -0,0 +1,373 @@
+"""
+Manifest of catalogs and noise records
+
+Keeps a SQLite database (by default manifest.sqlite) with one row per
+catalog, holding its G-R parameters, seed, summary statistics and file hash,
+and one row per noise record, with its header values, hash and the catalog
+it was computed from.  The noise scripts list the path of that catalog in
+the .segments.json index of the record, which is read at every update.
+Updates are incremental: only files whose size or modification time
+changed are read again, and rows of deleted files are dropped.  Queries
+only touch the database, so no catalog is unpickled.
+
+Usage: python manifest.py [-m MANIFEST] update [--catalogs DIR ...]
+                                               [--records DIR ...]
+       python manifest.py [-m MANIFEST] query [--b B [B]]
+                                              [--m0total M0 [M0]]
+                                              [--max-m0 M0 [M0]]
+                                              [--max-dep DEP [DEP]]
+                                              [--length SEC [SEC]]
+                                              [--records]
+
+Each query option takes one value, matched to a relative tolerance of 1e-6,
+or a range of two values.  For example, the catalogs with b = 1 and
+max_m0 between 1e16 and 1e17 Nm, with their noise records, are listed by
+
+python manifest.py query --b 1 --max-m0 1e16 1e17 --records
+
+Records are matched to the catalog listed in their index.  Records without
+one (computed before catalogs were listed) are matched to the catalog with
+the longest file root (e.g. Titan_cycle_3) contained in the record
+filename.
+"""
+
+import gutenbergrichter as gr
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+try:
+    from obspy import read
+except ImportError:
+    read = None
+
+default_manifest = 'manifest.sqlite'
+catalog_extensions = ('.pkl', '.grcat')
+# Suffix of the segment indexes written next to noise records
+index_suffix = '.segments.json'
+# Columns of the catalogs table that can be queried
+query_columns = ('a', 'b', 'm0total', 'max_m0', 'min_m0', 'max_dep', 'length',
+                 'nevents', 'max_Mw', 'moment')
+
+schema = """
+CREATE TABLE IF NOT EXISTS catalogs (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT,
+    a REAL, b REAL, m0total REAL, max_m0 REAL, min_m0 REAL, max_dep REAL,
+    length REAL, nevents INTEGER, max_Mw REAL, moment REAL,
+    seed TEXT, realization INTEGER);
+CREATE INDEX IF NOT EXISTS catalogs_params
+    ON catalogs (b, m0total, max_m0, max_dep);
+CREATE TABLE IF NOT EXISTS records (
+    path TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT,
+    catalog TEXT, source TEXT, channel TEXT, npts INTEGER,
+    sampling_rate REAL);
+CREATE INDEX IF NOT EXISTS records_catalog ON records (catalog);
+"""
+
+
+def connect(filename=default_manifest):
+    """
+    Function to open (and if needed create) a manifest database
+    """
+    conn = sqlite3.connect(filename)
+    conn.row_factory = sqlite3.Row
+    conn.executescript(schema)
+    return conn
+
+def file_stat(path):
+    """
+    Function to return the total size and latest modification time of a
+    file, or of all files in a catalog directory
+
+    Returns a tuple of size,mtime
+    """
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        return (st.st_size, st.st_mtime)
+    stats = [os.stat(name) for name in _dir_files(path)]
+    return (sum(st.st_size for st in stats),
+            max([st.st_mtime for st in stats] + [os.stat(path).st_mtime]))
+
+def file_hash(path, blocksize=1 << 20):
+    """
+    Function to return the sha256 hex digest of a file, or of the names
+    and contents of all files in a catalog directory
+    """
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        names = _dir_files(path)
+    else:
+        names = [path]
+    for name in names:
+        if os.path.isdir(path):
+            sha.update(os.path.relpath(name, path).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for block in iter(lambda: f.read(blocksize), b''):
+                sha.update(block)
+    return sha.hexdigest()
+
+def _dir_files(path):
+    return sorted(os.path.join(path, name) for name in os.listdir(path)
+                  if os.path.isfile(os.path.join(path, name)))
+
+def _find(dirs, catalogs):
+    """
+    Function to list catalogs (pickles and catalog directories) or record
+    files below a set of directories
+    """
+    found = []
+    for top in dirs:
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            if catalogs:
+                grcats = [name for name in dirnames
+                          if name.endswith('.grcat')]
+                found += [os.path.join(dirpath, name) for name in grcats]
+                # Do not descend into catalog directories
+                dirnames[:] = [name for name in dirnames
+                               if name not in grcats]
+                found += [os.path.join(dirpath, name) for name in filenames
+                          if name.endswith('.pkl')]
+            else:
+                found += [os.path.join(dirpath, name) for name in filenames
+                          if not name.startswith('.') and
+                          not name.endswith(index_suffix)]
+    return sorted(found)
+
+def _changed(conn, table, path):
+    """
+    Function to check whether a file differs from its manifest row
+
+    Returns a tuple of changed,size,mtime
+    """
+    (size, mtime) = file_stat(path)
+    row = conn.execute('SELECT size, mtime FROM %s WHERE path = ?' % table,
+                       (path,)).fetchone()
+    changed = (row is None) or (row['size'] != size) or (row['mtime'] != mtime)
+    return (changed, size, mtime)
+
+def index_catalog(conn, path, size=None, mtime=None):
+    """
+    Function to read a catalog and store its manifest row
+    """
+    if size is None:
+        (size, mtime) = file_stat(path)
+    gr_obj = gr.load_catalog(path)
+    catalog = gr_obj.catalog
+    seed = getattr(catalog, 'seed', None)
+    if seed is None:
+        seed = (None, None)
+    nevents = len(catalog)
+    if nevents:
+        max_Mw = float(catalog.magnitude.max())
+    else:
+        max_Mw = None
+    values = [getattr(gr_obj, name, None) for name in gr.gr_params[:5]]
+    # The depth range the events were drawn from, not the default of the
+    # GutenbergRichter object
+    values.append(getattr(catalog, 'max_dep', gr_obj.max_dep))
+    conn.execute('INSERT OR REPLACE INTO catalogs VALUES '
+                 '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 [path, size, mtime, file_hash(path)] + values +
+                 [catalog.length, nevents, max_Mw, float(catalog.moment()),
+                  None if seed[0] is None else str(seed[0]), seed[1]])
+
+def index_record(conn, path, size=None, mtime=None):
+    """
+    Function to read the header of a noise record and store its manifest
+    row, without a matching catalog yet (see match_records)
+
+    Header values are left empty if ObsPy is missing or cannot read the
+    file
+    """
+    if size is None:
+        (size, mtime) = file_stat(path)
+    (channel, npts, sampling_rate) = (None, None, None)
+    if read is not None:
+        try:
+            tr = read(path, headonly=True)[0]
+            channel = tr.stats.channel
+            npts = tr.stats.npts
+            sampling_rate = tr.stats.sampling_rate
+        except Exception:
+            pass
+    conn.execute('INSERT OR REPLACE INTO records (path, size, mtime, sha256, '
+                 'catalog, channel, npts, sampling_rate) VALUES '
+                 '(?, ?, ?, ?, ?, ?, ?, ?)',
+                 (path, size, mtime, file_hash(path), None, channel, npts,
+                  sampling_rate))
+
+def read_indexes(conn, dirs):
+    """
+    Function to set the source catalog of the records listed in the
+    segment indexes below a set of directories
+
+    Files are looked up next to their index, so records can be moved
+    together with it
+    """
+    for top in dirs:
+        for (dirpath, dirnames, filenames) in os.walk(top):
+            for name in filenames:
+                if not name.endswith(index_suffix):
+                    continue
+                try:
+                    with open(os.path.join(dirpath, name)) as f:
+                        index = json.load(f)
+                except ValueError:
+                    # Being written
+                    continue
+                if index.get('catalog') is None:
+                    continue
+                files = [os.path.join(dirpath, os.path.basename(filename))
+                         for entry in index['segments']
+                         for filename in entry['files']]
+                conn.executemany('UPDATE records SET source = ? '
+                                 'WHERE path = ?',
+                                 [(index['catalog'], path) for path in files])
+
+def match_records(conn):
+    """
+    Function to link every record to its source catalog, or if it has
+    none, to the catalog with the longest file root contained in the
+    record filename
+    """
+    roots = []
+    paths = {}
+    for row in conn.execute('SELECT path FROM catalogs'):
+        name = os.path.basename(row['path'].rstrip(os.sep))
+        roots.append((os.path.splitext(name)[0], row['path']))
+        paths[os.path.realpath(row['path'])] = row['path']
+    roots.sort(key=lambda item: len(item[0]), reverse=True)
+    for row in conn.execute('SELECT path, source FROM records').fetchall():
+        catalog = None
+        if row['source'] is not None:
+            catalog = paths.get(os.path.realpath(row['source']))
+        else:
+            name = os.path.basename(row['path'])
+            for (root, path) in roots:
+                if root in name:
+                    catalog = path
+                    break
+        conn.execute('UPDATE records SET catalog = ? WHERE path = ?',
+                     (catalog, row['path']))
+
+def update(conn, catalog_dirs=('catalogs',), record_dirs=('noise_records',)):
+    """
+    Function to bring the manifest up to date with the catalogs and records
+    below catalog_dirs and record_dirs
+
+    Only new or modified files are read and hashed.  Rows of files that no
+    longer exist are removed.
+
+    Returns a tuple of nindexed,nremoved
+    """
+    nindexed = 0
+    nremoved = 0
+    for (table, dirs, index) in (('catalogs', catalog_dirs, index_catalog),
+                                 ('records', record_dirs, index_record)):
+        paths = _find(dirs, table == 'catalogs')
+        for path in paths:
+            (changed, size, mtime) = _changed(conn, table, path)
+            if changed:
+                index(conn, path, size, mtime)
+                nindexed += 1
+        current = set(paths)
+        tops = tuple(os.path.join(top, '') for top in dirs)
+        for row in conn.execute('SELECT path FROM %s' % table).fetchall():
+            if row['path'].startswith(tops) and row['path'] not in current:
+                conn.execute('DELETE FROM %s WHERE path = ?' % table,
+                             (row['path'],))
+                nremoved += 1
+    read_indexes(conn, record_dirs)
+    match_records(conn)
+    conn.commit()
+    return (nindexed, nremoved)
+
+def find_catalogs(conn, rtol=1e-6, **conditions):
+    """
+    Function to return the manifest rows of the catalogs matching a set of
+    conditions, e.g. find_catalogs(conn, b=1.0, max_m0=(1e16, 1e17))
+
+    Each condition is a column of query_columns with either a single value,
+    matched to a relative tolerance rtol, or a (low, high) range
+    """
+    clauses = []
+    values = []
+    for (name, value) in sorted(conditions.items()):
+        if name not in query_columns:
+            raise ValueError("cannot query catalogs by %s" % name)
+        if isinstance(value, (tuple, list)):
+            (low, high) = value
+            clauses.append('%s BETWEEN ? AND ?' % name)
+            values += [low, high]
+        else:
+            clauses.append('ABS(%s - ?) <= ?' % name)
+            values += [value, rtol*abs(value)]
+    sql = 'SELECT * FROM catalogs'
+    if clauses:
+        sql += ' WHERE ' + ' AND '.join(clauses)
+    return conn.execute(sql + ' ORDER BY path', values).fetchall()
+
+def find_records(conn, catalog):
+    """
+    Function to return the manifest rows of the records computed from the
+    catalog with path catalog
+    """
+    return conn.execute('SELECT * FROM records WHERE catalog = ? '
+                        'ORDER BY path', (catalog,)).fetchall()
+
+def _format(value):
+    return 'None' if value is None else '%.3g' % value
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Indexes and queries '
+                                                  + 'catalogs and noise '
+                                                  + 'records.'))
+    parser.add_argument('-m', '--manifest', default=default_manifest,
+                        help='Manifest database file')
+    subparsers = parser.add_subparsers(dest='command')
+    parser_update = subparsers.add_parser('update',
+                                          help='Update the manifest')
+    parser_update.add_argument('--catalogs', nargs='+', default=['catalogs'],
+                               help='Directories holding catalogs')
+    parser_update.add_argument('--records', nargs='+',
+                               default=['noise_records'],
+                               help='Directories holding noise records')
+    parser_query = subparsers.add_parser('query',
+                                         help='List matching catalogs')
+    for name in ('b', 'm0total', 'max_m0', 'min_m0', 'max_dep', 'length',
+                 'nevents'):
+        parser_query.add_argument('--' + name.replace('_', '-'), type=float,
+                                  nargs='+', metavar='VALUE',
+                                  help='Value or range of %s' % name)
+    parser_query.add_argument('--records', action='store_true',
+                              help='Also list the noise records')
+    args = parser.parse_args()
+
+    conn = connect(args.manifest)
+    if args.command == 'update':
+        (nindexed, nremoved) = update(conn, args.catalogs, args.records)
+        print('Indexed %d files, removed %d' % (nindexed, nremoved))
+    elif args.command == 'query':
+        conditions = {}
+        for name in ('b', 'm0total', 'max_m0', 'min_m0', 'max_dep', 'length',
+                     'nevents'):
+            value = getattr(args, name)
+            if value is None:
+                continue
+            if len(value) > 2:
+                parser.error('--%s takes one value or a range of two' %
+                             name.replace('_', '-'))
+            conditions[name] = value[0] if len(value) == 1 else tuple(value)
+        for row in find_catalogs(conn, **conditions):
+            values = [_format(row[name]) for name
+                      in ('b', 'm0total', 'max_m0', 'max_dep')]
+            print('%s: b %s, m0total %s, max_m0 %s, max_dep %s, %d events, '
+                  'M0 %.3g' % tuple([row['path']] + values +
+                                    [row['nevents'], row['moment']]))
+            if args.records:
+                for record in find_records(conn, row['path']):
+                    print('    %s' % record['path'])
+    else:
+        parser.print_help()
+    conn.close()
@@ -0,0 +1,390 @@
+"""
+Accumulators for noise records
+
+MemoryRecord holds the record in a NumPy array, as generate_noise.py always
+did.  MappedRecord keeps it in a file instead, split into blocks of block
+samples of all components, and memory-maps only the blocks that events
+touch, keeping at most max_blocks of them mapped (least recently used
+blocks are flushed and unmapped).  Since events come in time order, this
+bounds the memory of the record, and its length is only limited by disk.
+The file is created sparse, so untouched blocks take no space either.
+
+Both have the same methods: add an (ncomponents, n) array at a sample
+offset, read a range of samples or a whole component, and flush pending
+writes.  A MappedRecord file can be opened again with MappedRecord.open,
+from the header written next to it (filename + '.json').
+
+SegmentWriter writes a record in segments of fixed length as events are
+added, each as soon as no later event can reach it, as SAC or as Steim-2
+compressed miniSEED.
+"""
+
+import collections
+import json
+import os
+import numpy as np
+import obspy
+
+# Default block of a MappedRecord, 2**20 samples (24 MB for three float64
+# components)
+default_block = 2**20
+
+
+class MemoryRecord(object):
+    """
+    A noise record of nsamples samples of ncomp components in memory
+    """
+
+    def __init__(self, ncomp, nsamples, dtype=np.float64):
+        self.ncomp = ncomp
+        self.nsamples = nsamples
+        self.data = np.zeros((ncomp, nsamples), dtype=dtype)
+
+    def add(self, data, offset):
+        """
+        Function to add an (ncomp, n) array to the record starting at
+        sample offset, dropping samples past its end
+        """
+        n = min(data.shape[1], self.nsamples - offset)
+        if n > 0:
+            self.data[:, offset:offset + n] += data[:, :n]
+
+    def read(self, start=0, stop=None):
+        """
+        Function to return samples start to stop of all components, as an
+        (ncomp, stop - start) array
+        """
+        return self.data[:, start:stop]
+
+    def component(self, i, start=0, stop=None):
+        """
+        Function to return samples start to stop of component i
+        """
+        return self.data[i, start:stop]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class MappedRecord(object):
+    """
+    A noise record of nsamples samples of ncomp components in the file
+    filename, stored as (nblocks, ncomp, block) and mapped one block at a
+    time
+    """
+
+    def __init__(self, filename, ncomp, nsamples, block=default_block,
+                 max_blocks=8, dtype=np.float64, create=True):
+        if block < 1:
+            raise ValueError("block must be at least one sample")
+        if max_blocks < 1:
+            raise ValueError("max_blocks must be at least 1")
+        self.filename = filename
+        self.ncomp = ncomp
+        self.nsamples = nsamples
+        self.block = block
+        self.max_blocks = max_blocks
+        self.dtype = np.dtype(dtype)
+        self.nblocks = -(-nsamples // block)
+        self.block_bytes = ncomp*block*self.dtype.itemsize
+        self.maps = collections.OrderedDict()
+        if create:
+            # Sparse file of zeros
+            with open(filename, 'wb') as f:
+                f.truncate(self.nblocks*self.block_bytes)
+            with open(filename + '.json', 'w') as f:
+                json.dump({'ncomp': ncomp, 'nsamples': nsamples,
+                           'block': block, 'dtype': self.dtype.str}, f)
+        elif os.path.getsize(filename) != self.nblocks*self.block_bytes:
+            raise ValueError("%s does not match its header" % filename)
+
+    @classmethod
+    def open(cls, filename, max_blocks=8):
+        """
+        Function to open an existing record file
+        """
+        with open(filename + '.json') as f:
+            header = json.load(f)
+        return cls(filename, header['ncomp'], header['nsamples'],
+                   block=header['block'], max_blocks=max_blocks,
+                   dtype=header['dtype'], create=False)
+
+    def _map(self, k):
+        """
+        Function to return block k as a memory-mapped (ncomp, block) array
+        """
+        if k in self.maps:
+            self.maps.move_to_end(k)
+            return self.maps[k]
+        while len(self.maps) >= self.max_blocks:
+            (old, m) = self.maps.popitem(last=False)
+            m.flush()
+            del m
+        m = np.memmap(self.filename, dtype=self.dtype, mode='r+',
+                      offset=k*self.block_bytes, shape=(self.ncomp,
+                                                        self.block))
+        self.maps[k] = m
+        return m
+
+    def add(self, data, offset):
+        """
+        Function to add an (ncomp, n) array to the record starting at
+        sample offset, dropping samples past its end
+        """
+        stop = min(offset + data.shape[1], self.nsamples)
+        start = offset
+        while start < stop:
+            k = start // self.block
+            i = start - k*self.block
+            n = min(stop - start, self.block - i)
+            self._map(k)[:, i:i + n] += data[:, start - offset:
+                                             start - offset + n]
+            start += n
+
+    def read(self, start=0, stop=None):
+        """
+        Function to return a copy of samples start to stop of all
+        components, as an (ncomp, stop - start) array
+        """
+        if stop is None:
+            stop = self.nsamples
+        stop = min(stop, self.nsamples)
+        out = np.zeros((self.ncomp, max(stop - start, 0)), dtype=self.dtype)
+        n0 = start
+        while n0 < stop:
+            k = n0 // self.block
+            i = n0 - k*self.block
+            n = min(stop - n0, self.block - i)
+            out[:, n0 - start:n0 - start + n] = self._map(k)[:, i:i + n]
+            n0 += n
+        return out
+
+    def component(self, i, start=0, stop=None):
+        """
+        Function to return a copy of samples start to stop of component i
+        """
+        if stop is None:
+            stop = self.nsamples
+        stop = min(stop, self.nsamples)
+        out = np.zeros(max(stop - start, 0), dtype=self.dtype)
+        n0 = start
+        while n0 < stop:
+            k = n0 // self.block
+            j = n0 - k*self.block
+            n = min(stop - n0, self.block - j)
+            out[n0 - start:n0 - start + n] = self._map(k)[i, j:j + n]
+            n0 += n
+        return out
+
+    def flush(self):
+        """
+        Function to write all mapped blocks to disk
+        """
+        for m in self.maps.values():
+            m.flush()
+
+    def close(self):
+        """
+        Function to flush and unmap all blocks
+        """
+        self.flush()
+        self.maps.clear()
+
+
+def open_record(ncomp, nsamples, filename=None, block=default_block,
+                max_blocks=8):
+    """
+    Function to create an empty record, memory-mapped in filename if given
+    and in memory otherwise
+    """
+    if filename is None:
+        return MemoryRecord(ncomp, nsamples)
+    return MappedRecord(filename, ncomp, nsamples, block=block,
+                        max_blocks=max_blocks)
+
+
+class SegmentWriter(object):
+    """
+    A record that is written out in segments of segment samples (the whole
+    record if None) while events are added in time order
+
+    stats are the obspy trace headers (one per component) of the output,
+    starting at the first sample of the record.  Segment k of channel MXZ
+    is written to root.kkkk.MXZ (root.MXZ for the whole record), with a
+    .mseed extension for miniSEED, and plotted to root.kkkk.png (noise.png
+    for the whole record) if plot is set.
+
+    Steim-2 compresses integers, so miniSEED traces are counts of a step
+    chosen per segment and channel, a power of two giving 2**23 counts to
+    the largest sample.  The steps are listed in root.segments.json along
+    with the files of every finished segment, so it can be read while the
+    record is still being computed.  catalog, if given, is the path of the
+    catalog the record is computed from, which is also listed there (for
+    manifest.py).
+
+    Segments given in the hold argument of add and write_until (e.g. those
+    of events that failed) are passed over and kept in held, to be
+    written with write_segment once they are complete.  close writes them
+    anyway, and lists those still held as incomplete in the index.
+    """
+
+    def __init__(self, record, stats, root, segment=None, format='SAC',
+                 plot=False, catalog=None):
+        if format not in ('SAC', 'MSEED'):
+            raise ValueError("cannot write %s segments" % format)
+        if segment is None:
+            segment = record.nsamples
+        if segment < 1:
+            raise ValueError("segment must be at least one sample")
+        self.record = record
+        self.nsamples = record.nsamples
+        self.stats = stats
+        self.root = root
+        self.segment = segment
+        self.format = format
+        self.plot = plot
+        self.catalog = catalog
+        self.whole = (segment >= record.nsamples)
+        # First sample of the segments not written or held yet
+        self.written = 0
+        self.segments = []
+        self.held = set()
+
+    def segments_of(self, start, stop):
+        """
+        Function to return the numbers of the segments holding samples
+        start to stop
+        """
+        stop = min(stop, self.nsamples)
+        if stop <= start:
+            return range(0)
+        return range(start // self.segment, (stop - 1) // self.segment + 1)
+
+    def add(self, data, offset, hold=()):
+        """
+        Function to add an (ncomp, n) array to the record starting at
+        sample offset, after writing the segments that end before it
+        (except those in hold)
+
+        Events are added in time order, except into held segments
+        """
+        if offset < self.written:
+            passed = [k for k in self.segments_of(offset, offset +
+                                                  data.shape[1])
+                      if (k + 1)*self.segment <= self.written]
+            if not self.held.issuperset(passed):
+                raise ValueError("events must be added in time order")
+        self.write_until(offset, hold)
+        self.record.add(data, offset)
+
+    def write_until(self, sample, hold=()):
+        """
+        Function to write all segments ending at or before sample, except
+        those in hold, which are held
+        """
+        while self.written + self.segment <= min(sample, self.nsamples):
+            k = self.written // self.segment
+            if k in hold:
+                self.held.add(k)
+            else:
+                self._write(self.written, self.written + self.segment)
+            self.written += self.segment
+
+    def write_segment(self, k):
+        """
+        Function to write held segment k, once it is complete
+        """
+        self.held.discard(k)
+        self._write(k*self.segment, min((k + 1)*self.segment,
+                                        self.nsamples))
+        # The index may list it as incomplete
+        self._write_index()
+
+    def close(self, hold=()):
+        """
+        Function to write the remaining segments, including the held ones
+        and those in hold (which are held too), and close the record
+        """
+        while self.written < self.nsamples:
+            k = self.written // self.segment
+            if k in hold:
+                self.held.add(k)
+            else:
+                self._write(self.written, min(self.written + self.segment,
+                                              self.nsamples))
+            self.written = min(self.written + self.segment, self.nsamples)
+        written = set(entry['segment'] for entry in self.segments)
+        for k in sorted(self.held - written):
+            self._write(k*self.segment, min((k + 1)*self.segment,
+                                            self.nsamples))
+        if self.held:
+            self._write_index()
+        self.record.close()
+
+    def _write(self, start, stop):
+        """
+        Function to write samples start to stop, one component at a time
+        """
+        k = start // self.segment
+        entry = {'segment': k, 'start': start, 'npts': stop - start,
+                 'starttime': str(self.stats[0].starttime +
+                                  start*self.stats[0].delta),
+                 'files': []}
+        if self.whole:
+            name = self.root
+        else:
+            name = '%s.%04d' % (self.root, k)
+        st = obspy.Stream()
+        for (i, stats) in enumerate(self.stats):
+            header = stats.copy()
+            header.starttime = stats.starttime + start*stats.delta
+            header.npts = stop - start
+            tr = obspy.Trace(data=self.record.component(i, start, stop),
+                             header=header)
+            filename = '%s.%s' % (name, tr.stats.channel)
+            if self.format == 'SAC':
+                tr.write(filename, format='SAC')
+            else:
+                filename += '.mseed'
+                step = quantum(tr.data)
+                entry.setdefault('steps', []).append(step)
+                counts = obspy.Trace(data=np.round(tr.data/step).astype(
+                    np.int32), header=header)
+                counts.write(filename, format='MSEED', encoding='STEIM2')
+            entry['files'].append(filename)
+            print(tr)
+            if self.plot:
+                st += tr
+        if self.plot:
+            st.plot(outfile='noise.png' if self.whole else name + '.png')
+        # A held segment is written again once complete
+        self.segments = [old for old in self.segments
+                         if old['segment'] != k] + [entry]
+        self.segments.sort(key=lambda entry: entry['segment'])
+        if (not self.whole or self.format == 'MSEED' or
+                self.catalog is not None or self.held):
+            self._write_index()
+
+    def _write_index(self):
+        filename = self.root + '.segments.json'
+        tmpname = '%s.%d.tmp' % (filename, os.getpid())
+        with open(tmpname, 'w') as f:
+            json.dump({'segment': self.segment, 'nsamples': self.nsamples,
+                       'format': self.format, 'catalog': self.catalog,
+                       'incomplete': sorted(self.held),
+                       'segments': self.segments}, f, indent=1)
+        os.replace(tmpname, filename)
+
+
+def quantum(data, bits=23):
+    """
+    Function to return the power of two step giving 2**bits counts to the
+    largest absolute value of data (1 for all zeros)
+    """
+    peak = np.max(np.abs(data)) if len(data) else 0.0
+    if peak == 0.0:
+        return 1.0
+    return float(2.0**np.ceil(np.log2(peak/2.0**bits)))
@@ -0,0 +1,366 @@
+"""
+Shared tools for computing noise records from catalogs with Instaseis
+
+plan_sources turns a catalog into an array of source records, one per
+event to be computed, holding everything needed to build an
+instaseis.Source and to place its seismogram in the noise record.  The
+records are computed for all events at once, so the waveform loop of
+generate_noise.py and generate_noise_sampled.py only reads them.
+
+get_postprocessor returns the end taper and decimation applied to every
+seismogram, built once per record length and sampling and then shared.
+
+parallel_seismograms spreads the Instaseis queries and post-processing of
+the events over a pool of worker processes.
+"""
+
+import gutenbergrichter as gr
+import seiscache
+import numpy as np
+import instaseis
+import multiprocessing
+import random
+import sys
+import time
+from scipy.signal import cheb2ord, cheby2, sosfilt
+python3 = sys.version_info > (3,0)
+
+if not python3:
+    from requests.exceptions import ConnectionError
+# Remote databases raise the requests exceptions, which are not the built-in
+# ConnectionError
+try:
+    from requests.exceptions import RequestException
+except ImportError:
+    RequestException = ConnectionError
+retry_errors = (ConnectionError, RequestException, TypeError)
+
+# Fields of a source plan.  latitude and longitude place the event for a
+# receiver at the north pole, depth_in_m is clamped to the database, and
+# offset is the first sample of the event in the noise record.
+plan_fields = ('event', 'time', 'offset', 'latitude', 'longitude',
+               'depth_in_m', 'M0', 'm_rr', 'm_tt', 'm_pp', 'm_rt', 'm_rp',
+               'm_tp')
+plan_dtype = np.dtype([(name, np.int64 if name in ('event', 'offset')
+                        else np.float64) for name in plan_fields])
+
+
+def db_max_depth(db):
+    """
+    Function to return the maximum source depth (m) of an Instaseis
+    database
+    """
+    return db.info.planet_radius - db.info.min_radius
+
+def limit_depths(depth, db_maxdepth):
+    """
+    Function to keep source depths (m) within the database
+
+    Hack: depths larger than the maximum depth of the database are scaled
+    to the range (0, max_depth), assuming that the catalog maximum depth is
+    10 km, which is the hardcoded value right now
+    """
+    depth = np.array(depth, dtype=np.float64)
+    deep = depth > db_maxdepth
+    depth[deep] *= db_maxdepth / 10e3
+    return depth
+
+def moment_tensors(strike, dip, rake, M0):
+    """
+    Function to convert strike, dip and rake (deg) and scalar moments (Nm)
+    to moment tensor components, as instaseis.Source.from_strike_dip_rake
+    does for a single event
+
+    Returns a tuple of m_rr,m_tt,m_pp,m_rt,m_rp,m_tp
+    """
+    phi = np.deg2rad(strike)
+    delta = np.deg2rad(dip)
+    lambd = np.deg2rad(rake)
+
+    m_tt = (-np.sin(delta) * np.cos(lambd) * np.sin(2.0 * phi)
+            - np.sin(2.0 * delta) * np.sin(phi) ** 2.0 * np.sin(lambd)) * M0
+    m_pp = (np.sin(delta) * np.cos(lambd) * np.sin(2.0 * phi)
+            - np.sin(2.0 * delta) * np.cos(phi) ** 2.0 * np.sin(lambd)) * M0
+    m_rr = (np.sin(2.0 * delta) * np.sin(lambd)) * M0
+    m_rp = (-np.cos(phi) * np.sin(lambd) * np.cos(2.0 * delta)
+            + np.cos(delta) * np.cos(lambd) * np.sin(phi)) * M0
+    m_rt = (-np.sin(lambd) * np.sin(phi) * np.cos(2.0 * delta)
+            - np.cos(delta) * np.cos(lambd) * np.cos(phi)) * M0
+    m_tp = (-np.sin(delta) * np.cos(lambd) * np.cos(2.0 * phi)
+            - np.sin(2.0 * delta) * np.sin(2.0 * phi) * np.sin(lambd) / 2.0
+            ) * M0
+    return (m_rr, m_tt, m_pp, m_rt, m_rp, m_tp)
+
+def plan_sources(catalog, dt_out, db_maxdepth, min_Mw=None):
+    """
+    Function to compute the source records of all events of a catalog
+    that need waveforms
+
+    Events below min_Mw (if given) are left out.  dt_out is the sample
+    interval of the noise record and db_maxdepth the maximum depth of the
+    database in m (see db_max_depth).
+
+    Returns a tuple of plan,mask with plan a record array with the fields
+    of plan_fields, in catalog order, and mask the boolean selection of
+    catalog events
+    """
+    magnitude = np.asarray(catalog.magnitude, dtype=np.float64)
+    if min_Mw is None:
+        mask = np.ones(len(magnitude), dtype=bool)
+    else:
+        mask = magnitude >= min_Mw
+
+    plan = np.empty(np.count_nonzero(mask), dtype=plan_dtype)
+    plan['event'] = np.flatnonzero(mask)
+    plan['time'] = catalog.time[mask]
+    plan['offset'] = (plan['time']/dt_out).astype(np.int64)
+    plan['latitude'] = 90.0 - catalog.delta[mask]
+    longitude = np.asarray(catalog.backaz[mask], dtype=np.float64)
+    plan['longitude'] = np.where(longitude > 180.0, longitude - 360.0,
+                                 longitude)
+    plan['depth_in_m'] = limit_depths(catalog.depth[mask] * 1000.,
+                                      db_maxdepth)
+    plan['M0'] = gr.calc_m0(magnitude[mask])
+    (plan['m_rr'], plan['m_tt'], plan['m_pp'], plan['m_rt'], plan['m_rp'],
+     plan['m_tp']) = moment_tensors(catalog.strike[mask], catalog.dip[mask],
+                                    catalog.rake[mask], plan['M0'])
+    return (plan.view(np.recarray), mask)
+
+def cosine_taper(npts, t1, t2, t3, t4):
+    """
+    Function to calculate a cosine taper over samples 0 to npts - 1
+
+    returns weight coefficients between 0 and 1
+
+    cosine taper from 0 to 1 t1 < t < t2
+    1 for t2 < t < t3
+    cosine taper from 1 to 0 t3 < t < t4
+    0 for t < t1 or t > t4
+    """
+    if t3 > t4:
+        raise ValueError('cosine_taper: t3>t4')
+    if t1 > t2:
+        raise ValueError('cosine_taper: t1>t2')
+
+    t = np.arange(npts, dtype=np.float64)
+    wt = np.zeros(npts)
+    rise = (t > t1) & (t < t2)
+    wt[rise] = 0.5 * (1.0 + np.cos(np.pi * (t[rise] - t2)/(t2 - t1)))
+    fall = (t > t3) & (t < t4)
+    wt[fall] = 0.5 * (1.0 + np.cos(np.pi * (t[fall] - t3)/(t4 - t3)))
+    wt[(t >= t2) & (t <= t3)] = 1.0
+    return wt
+
+def decimation_filter(factor):
+    """
+    Function to design the anti-alias filter used before decimating by
+    factor, the same Chebyshev type II lowpass that ObsPy's decimate uses
+
+    Returns the filter as second-order sections
+    """
+    if factor > 16:
+        raise ArithmeticError("Automatic filter design is unstable for "
+                              "decimation factors above 16")
+    # Stop band at the new Nyquist frequency (relative to the old one),
+    # -96 dB, and a pass band lowered until the filter order is at most 12
+    ws = 1.0/factor
+    wp = ws
+    (rp, rs, order) = (1, 96, 1e99)
+    while order > 12:
+        wp = wp * 0.99
+        (order, wn) = cheb2ord(wp, ws, rp, rs, analog=0)
+    return cheby2(order, rs, wn, btype='low', analog=0, output='sos')
+
+
+class PostProcessor(object):
+    """
+    Taper and decimation applied to all seismograms of a database
+
+    The end taper falls to 0 over the last taperFrac of the record (after
+    cutting endCutFrac of it), and factor, if given, is the decimation
+    factor, with the anti-alias filter of ObsPy's decimate.  key holds all
+    the parameters, e.g. to check that stored results used the same ones.
+    """
+
+    def __init__(self, npts, dt, factor=None, taperFrac=0.05, endCutFrac=0.0):
+        self.npts = npts
+        self.dt = dt
+        self.factor = factor
+        self.key = (npts, dt, factor, taperFrac, endCutFrac)
+        t4 = int(npts * (1 - endCutFrac)) - 1
+        t3 = int(t4 - taperFrac * npts)
+        self.taper = cosine_taper(npts, 0, 0, t3, t4)
+        if factor is None:
+            self.sos = None
+            self.dt_out = dt
+            self.npts_out = npts
+        else:
+            self.sos = decimation_filter(factor)
+            self.dt_out = dt * factor
+            self.npts_out = -(-npts // factor)
+
+    def __call__(self, data):
+        """
+        Function to taper and decimate an (ncomponents, npts) array of
+        seismograms in one pass
+
+        Returns the processed array
+        """
+        data = np.asarray(data, dtype=np.float64) * self.taper
+        if self.sos is not None:
+            data = sosfilt(self.sos, data, axis=-1)[:, ::self.factor]
+        return data
+
+
+_postprocessors = {}
+
+def get_postprocessor(npts, dt, factor=None, taperFrac=0.05, endCutFrac=0.0):
+    """
+    Function to return the PostProcessor for a record length and sampling,
+    building it on first use
+    """
+    key = (npts, dt, factor, taperFrac, endCutFrac)
+    if key not in _postprocessors:
+        _postprocessors[key] = PostProcessor(npts, dt, factor=factor,
+                                             taperFrac=taperFrac,
+                                             endCutFrac=endCutFrac)
+    return _postprocessors[key]
+
+def segment_seconds(value):
+    """
+    Function to convert a segment length, a number of seconds or 'day' or
+    'cycle' (a tidal cycle), to seconds
+    """
+    if value == 'day':
+        return 86400.0
+    if value == 'cycle':
+        return float(gr.seccycle)
+    seconds = float(value)
+    if seconds <= 0.0:
+        raise ValueError("segment length must be positive")
+    return seconds
+
+def open_database(url, cache_dir=None,
+                  max_bytes=seiscache.default_max_bytes):
+    """
+    Function to open an Instaseis database, looking seismograms up in the
+    on-disk cache in cache_dir (if given) first
+    """
+    db = instaseis.open_db(url)
+    if cache_dir is not None:
+        cache = seiscache.SeismogramCache(cache_dir, max_bytes=max_bytes)
+        db = seiscache.CachedDB(db, cache, name=url)
+    return db
+
+def make_source(event):
+    """
+    Function to build the instaseis.Source of a source record
+    """
+    return instaseis.Source(latitude=event.latitude,
+                            longitude=event.longitude,
+                            depth_in_m=event.depth_in_m,
+                            m_rr=event.m_rr, m_tt=event.m_tt,
+                            m_pp=event.m_pp, m_rt=event.m_rt,
+                            m_rp=event.m_rp, m_tp=event.m_tp)
+
+def backoff_delay(attempt, backoff=0.5, max_backoff=30.0, rng=random):
+    """
+    Function to return the wait (s) before retry number attempt (from 0):
+    exponential backoff with full jitter, uniform between 0 and
+    backoff*2**attempt, capped at max_backoff
+    """
+    return rng.uniform(0.0, min(max_backoff, backoff*2.0**attempt))
+
+def fetch_seismograms(db, source, receiver, maxRetry=100, backoff=0.5,
+                      max_backoff=30.0):
+    """
+    Function to get the seismograms of a source, retrying up to maxRetry
+    times on http-related errors with backoff_delay between attempts
+
+    Returns an obspy Stream, or None if all attempts failed
+    """
+    for i in range(maxRetry + 1):
+        if i > 0:
+            time.sleep(backoff_delay(i - 1, backoff, max_backoff))
+        try:
+            return db.get_seismograms(source=source, receiver=receiver,
+                                      remove_source_shift=False)
+        except retry_errors:
+            continue
+    print("Could not connect after max retries")
+    return None
+
+
+def processed(streams, post):
+    """
+    Function to taper and decimate (see PostProcessor) a sequence of
+    seismogram Streams, with None for failed queries
+
+    Yields a (3, n) array for every Stream, or None
+    """
+    for st in streams:
+        if st is None:
+            yield None
+        else:
+            yield post([tr.data for tr in st])
+
+
+# State of a synthesis worker process, set up by _init_worker
+_worker = {}
+
+def _init_worker(plan, url, cache_dir, max_bytes, receiver, post, maxRetry):
+    _worker['plan'] = plan
+    _worker['db'] = open_database(url, cache_dir=cache_dir,
+                                  max_bytes=max_bytes)
+    _worker['receiver'] = receiver
+    _worker['post'] = post
+    _worker['maxRetry'] = maxRetry
+
+def _worker_event(n):
+    """
+    Function to compute the processed seismograms of event n of the plan
+
+    Returns a tuple of data,hit with data None if the query failed and hit
+    whether the seismograms came from the cache (None without a cache)
+    """
+    db = _worker['db']
+    cache = getattr(db, 'cache', None)
+    if cache is not None:
+        hits = cache.hits
+    st = fetch_seismograms(db, make_source(_worker['plan'][n]),
+                           _worker['receiver'], _worker['maxRetry'])
+    hit = None if cache is None else (cache.hits > hits)
+    if st is None:
+        return (None, hit)
+    return (_worker['post']([tr.data for tr in st]), hit)
+
+def parallel_seismograms(plan, url, receiver, post, processes=None,
+                         cache_dir=None, max_bytes=seiscache.default_max_bytes,
+                         cache=None, maxRetry=100, chunksize=8):
+    """
+    Function to compute the seismograms of all events of a source plan with
+    a pool of processes worker processes
+
+    Each worker opens the database at url (with the cache in cache_dir, if
+    given) and returns tapered and decimated seismograms (see
+    PostProcessor).  The cache hits and misses of the workers are added to
+    those of cache, if given.
+
+    Yields the (3, n) array of every event in plan order, or None if its
+    query failed, so records summed from them are bit-identical for any
+    number of workers
+    """
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+                                initargs=(plan, url, cache_dir, max_bytes,
+                                          receiver, post, maxRetry))
+    try:
+        for (data, hit) in pool.imap(_worker_event, range(len(plan)),
+                                     chunksize):
+            if (cache is not None) and (hit is not None):
+                cache.hits += hit
+                cache.misses += not hit
+            yield data
+    finally:
+        # All tasks are done unless the caller stopped early
+        pool.terminate()
+        pool.join()
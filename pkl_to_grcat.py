@@ -0,0 +1,25 @@
+"""
+Convert catalog pickle files to memory-mappable catalog directories
+
+Usage: python pkl_to_grcat.py [pklfile ...]
+
+Each pickle file is written to a catalog directory with the same root and a
+.grcat extension.  With no arguments, every catalogs/*.pkl file is
+converted.  Catalogs are read back with gr.load_catalog.
+"""
+
+import gutenbergrichter as gr
+import glob
+import sys
+
+if len(sys.argv) > 1:
+    filenames = sys.argv[1:]
+else:
+    filenames = sorted(glob.glob('catalogs/*.pkl'))
+
+for filename in filenames:
+    root = '.'.join(filename.split('.')[:-1])
+    dirname = root + '.grcat'
+    gr_obj = gr.load_catalog(filename)
+    gr_obj.save_catalog(dirname)
+    print('%s -> %s (%d events)' % (filename, dirname, len(gr_obj.catalog)))
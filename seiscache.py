@@ -0,0 +1,218 @@
+"""
+Persistent on-disk cache of Instaseis seismograms
+
+Each seismogram is stored in its own file under the cache directory, named
+by the sha256 of the database identity, the source (location, depth and
+moment tensor), the receiver and the query options.  Taper, decimation and
+magnitude cuts are applied after the query, so runs of generate_noise.py
+on the same catalog that only differ in those read every seismogram from
+disk.
+
+Data are stored as float32 along with the trace headers, and the cache is
+kept below a size limit by evicting the least recently used files (hits
+update the file modification time).  Files are written atomically, so
+several processes can share a cache directory.
+"""
+
+import hashlib
+import json
+import os
+import numpy as np
+import obspy
+
+default_cache_dir = 'seismogram_cache'
+default_max_bytes = 10*1024**3
+# Source attributes that determine a seismogram
+source_keys = ('latitude', 'longitude', 'depth_in_m', 'm_rr', 'm_tt', 'm_pp',
+               'm_rt', 'm_rp', 'm_tp')
+# Database info fields that identify a database
+info_keys = ('directory', 'velocity_model', 'datetime', 'format_version',
+             'dt', 'npts', 'is_reciprocal')
+
+
+class SeismogramCache(object):
+    """
+    A directory of cached seismograms with a size limit of max_bytes
+    """
+
+    def __init__(self, directory=default_cache_dir,
+                 max_bytes=default_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.refresh()
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def refresh(self):
+        """
+        Function to recount the size of the cache from its files, e.g.
+        after other processes wrote to it
+        """
+        self.nbytes = sum(size for (path, size, mtime) in self._entries())
+
+    def _entries(self):
+        """
+        Function to list the cache files
+
+        Returns a list of (path, size, mtime) tuples
+        """
+        entries = []
+        for (dirpath, dirnames, filenames) in os.walk(self.directory):
+            for name in filenames:
+                if not name.endswith('.npz'):
+                    continue
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, st.st_size, st.st_mtime))
+        return entries
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.npz')
+
+    def key(self, db_id, source, receiver, **options):
+        """
+        Function to return the cache key of a query
+
+        db_id identifies the database (see database_id), and options are
+        the keyword arguments of get_seismograms
+        """
+        query = {'db': db_id,
+                 'source': ['%.17g' % float(getattr(source, name))
+                            for name in source_keys],
+                 'receiver': ['%.17g' % receiver.latitude,
+                              '%.17g' % receiver.longitude,
+                              receiver.network, receiver.station],
+                 'options': sorted((name, repr(value)) for (name, value)
+                                   in options.items())}
+        text = json.dumps(query, sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """
+        Function to read a cached seismogram
+
+        Returns an obspy Stream, or None if key is not in the cache
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as f:
+                data = f['data']
+                header = json.loads(str(f['header']))
+        except (IOError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        st = obspy.Stream()
+        for (trace, channel) in zip(data, header['channels']):
+            st += obspy.Trace(data=trace.astype(np.float64),
+                              header={'delta': header['delta'],
+                                      'starttime':
+                                      obspy.UTCDateTime(header['starttime']),
+                                      'network': header['network'],
+                                      'station': header['station'],
+                                      'location': header['location'],
+                                      'channel': channel})
+        return st
+
+    def put(self, key, st):
+        """
+        Function to store a seismogram Stream as float32, evicting old
+        entries if the cache grows past max_bytes
+
+        The traces of st are rounded to float32 in place, so they hold
+        exactly what get returns for key
+        """
+        path = self._path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        stats = st[0].stats
+        header = {'delta': stats.delta, 'starttime': str(stats.starttime),
+                  'network': stats.network, 'station': stats.station,
+                  'location': stats.location,
+                  'channels': [tr.stats.channel for tr in st]}
+        data = np.array([tr.data for tr in st], dtype=np.float32)
+        for (tr, trace) in zip(st, data):
+            tr.data = trace.astype(np.float64)
+        tmpname = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmpname, 'wb') as f:
+            np.savez(f, data=data, header=json.dumps(header))
+        os.replace(tmpname, path)
+        self.nbytes += os.path.getsize(path)
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def evict(self, target=0.9):
+        """
+        Function to delete the least recently used files until the cache
+        is below target times max_bytes
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self.nbytes = sum(size for (path, size, mtime) in entries)
+        for (path, size, mtime) in entries:
+            if self.nbytes <= target*self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.nbytes -= size
+
+    def report(self):
+        """
+        Function to return a one-line summary of the cache use
+        """
+        nqueries = self.hits + self.misses
+        if nqueries:
+            rate = 100.0*self.hits/nqueries
+        else:
+            rate = 0.0
+        return ('Seismogram cache %s: %d hits, %d misses (%.1f%% hit rate), '
+                '%.1f MB' % (self.directory, self.hits, self.misses, rate,
+                             self.nbytes/1024.0**2))
+
+
+class CachedDB(object):
+    """
+    An Instaseis database that looks seismograms up in a SeismogramCache
+    before querying the database
+
+    name (e.g. the database URL) is added to the database identity.  All
+    other attributes are those of db.
+    """
+
+    def __init__(self, db, cache, name=None):
+        self.db = db
+        self.cache = cache
+        self.db_id = database_id(db, name)
+
+    def __getattr__(self, name):
+        return getattr(self.db, name)
+
+    def get_seismograms(self, source, receiver, **kwargs):
+        key = self.cache.key(self.db_id, source, receiver, **kwargs)
+        st = self.cache.get(key)
+        if st is None:
+            st = self.db.get_seismograms(source=source, receiver=receiver,
+                                         **kwargs)
+            self.cache.put(key, st)
+        return st
+
+
+def database_id(db, name=None):
+    """
+    Function to return a string identifying an Instaseis database, from
+    name and the database info
+    """
+    info = db.info
+    return json.dumps([name] + [str(info.get(key)) for key in info_keys])
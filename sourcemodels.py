@@ -0,0 +1,158 @@
+"""
+Distributions of source locations, depths and focal mechanisms for
+synthetic catalogs
+
+Each distribution has a sample(n, rng) method that draws n values at once
+as NumPy arrays, with rng a np.random.Generator:
+
+location distributions return a tuple of delta,backaz (deg), the
+ epicentral distance and back azimuth from a receiver at the north pole,
+ i.e. the colatitude and longitude of the source
+depth distributions return depth (km)
+mechanism distributions return a tuple of strike,rake,dip (deg)
+
+UniformSphere, UniformDepth and UniformMechanism reproduce the original
+catalogs, and are the defaults of GutenbergRichter.generate_catalog.  Any
+object with a matching sample method can be used in their place.
+"""
+
+import numpy as np
+
+rad2deg = 180.0/np.pi
+deg2rad = np.pi/180.0
+
+
+class UniformSphere(object):
+    """
+    Epicenters uniformly distributed over the sphere
+    """
+
+    def sample(self, n, rng):
+        delta = rad2deg * np.arccos(rng.uniform(-1.0, 1.0, n))
+        backaz = rng.uniform(0, 360, n)
+        return (delta, backaz)
+
+
+class RegionalCluster(object):
+    """
+    Epicenters uniformly distributed within a spherical cap of angular
+    radius radius (deg) around the point delta,backaz
+    """
+
+    def __init__(self, delta, backaz, radius):
+        if (radius <= 0.0) or (radius > 180.0):
+            raise ValueError("radius must be between 0 and 180 degrees")
+        self.delta = delta
+        self.backaz = backaz
+        self.radius = radius
+
+    def sample(self, n, rng):
+        return sample_cap(self.delta, self.backaz, self.radius, n, rng)
+
+
+def sample_cap(delta, backaz, radius, n, rng):
+    """
+    Function to draw n epicenters uniformly within spherical caps of
+    angular radius radius (deg) around the points delta,backaz
+
+    delta and backaz can be single values or arrays of n centers, e.g. to
+    place each aftershock near its own mainshock
+
+    Returns a tuple of delta,backaz (deg)
+    """
+    # Draw points in a cap around the pole, then rotate the pole to the
+    # centers
+    cosr = np.cos(radius*deg2rad)
+    theta = np.arccos(rng.uniform(cosr, 1.0, n))
+    phi = rng.uniform(0.0, 2.0*np.pi, n)
+    x = np.sin(theta)*np.cos(phi)
+    y = np.sin(theta)*np.sin(phi)
+    z = np.cos(theta)
+
+    colat = np.asarray(delta)*deg2rad
+    lon = np.asarray(backaz)*deg2rad
+    # Rotate about y by the center colatitude, then about z by its
+    # longitude
+    xr = x*np.cos(colat) + z*np.sin(colat)
+    zr = -x*np.sin(colat) + z*np.cos(colat)
+    xs = xr*np.cos(lon) - y*np.sin(lon)
+    ys = xr*np.sin(lon) + y*np.cos(lon)
+
+    delta = rad2deg * np.arccos(np.clip(zr, -1.0, 1.0))
+    backaz = np.mod(rad2deg * np.arctan2(ys, xs), 360.0)
+    return (delta, backaz)
+
+
+class UniformDepth(object):
+    """
+    Depths uniformly distributed between 0 and max_dep (km)
+    """
+
+    def __init__(self, max_dep=10.0):
+        self.max_dep = max_dep
+
+    def sample(self, n, rng):
+        return rng.uniform(0, self.max_dep, n)
+
+
+class DepthProfile(object):
+    """
+    Depths following a layered profile
+
+    depths are the layer boundaries (km, increasing) and weights the
+    relative number of events in each layer (one fewer than depths).
+    Depths are uniform within each layer.
+    """
+
+    def __init__(self, depths, weights):
+        self.depths = np.asarray(depths, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) != len(self.depths) - 1:
+            raise ValueError("need one weight per layer")
+        if np.any(np.diff(self.depths) <= 0.0):
+            raise ValueError("depths must be increasing")
+        self.cdf = np.cumsum(weights)/np.sum(weights)
+        self.max_dep = self.depths[-1]
+
+    def sample(self, n, rng):
+        layer = np.searchsorted(self.cdf, rng.random(n), side='right')
+        layer = np.minimum(layer, len(self.cdf) - 1)
+        top = self.depths[layer]
+        bottom = self.depths[layer + 1]
+        return top + rng.random(n)*(bottom - top)
+
+
+class UniformMechanism(object):
+    """
+    Random focal mechanisms, with strike and rake uniform between 0 and 360
+    and dip uniform between 0 and 90 degrees
+    """
+
+    def sample(self, n, rng):
+        strike = rng.uniform(0, 360, n)
+        rake = rng.uniform(0, 360, n)
+        dip = rng.uniform(0, 90, n)
+        return (strike, rake, dip)
+
+
+class FixedMechanism(object):
+    """
+    A single focal mechanism for all events, optionally with a normally
+    distributed scatter (deg) on each angle
+    """
+
+    def __init__(self, strike, rake, dip, scatter=0.0):
+        self.strike = strike
+        self.rake = rake
+        self.dip = dip
+        self.scatter = scatter
+
+    def sample(self, n, rng):
+        strike = np.full(n, self.strike, dtype=np.float64)
+        rake = np.full(n, self.rake, dtype=np.float64)
+        dip = np.full(n, self.dip, dtype=np.float64)
+        if self.scatter > 0.0:
+            strike = np.mod(strike + rng.normal(0.0, self.scatter, n), 360.0)
+            rake = np.mod(rake + rng.normal(0.0, self.scatter, n), 360.0)
+            dip = np.clip(dip + rng.normal(0.0, self.scatter, n), 0.0, 90.0)
+        return (strike, rake, dip)
@@ -0,0 +1,105 @@
+"""
+Generate one synthetic Titan catalog per point of a grid of
+Gutenberg-Richter parameters, in parallel worker processes
+
+Usage: python sweep_catalogs_titan.py [--m0totalpercycle M0 ...]
+                                      [--max-m0 M0 ...] [--b B ...]
+                                      [--max-dep DEP ...] [-c NCYCLES]
+                                      [-s SEED] [-p PROCESSES] [-o OUTDIR]
+
+Each option takes one or more values, and a catalog is generated for every
+combination.  For example, the nominal, upper and lower bounds of
+generate_catalog_titan.py (an order of magnitude on m0total and max_m0)
+are covered by
+
+python sweep_catalogs_titan.py --m0totalpercycle 2.7e14 2.7e15 2.7e16 \
+    --max-m0 1.9e15 1.9e16 1.9e17
+
+Catalogs are written to OUTDIR (default catalogs/sweep) under names built
+from their parameters, and OUTDIR/summary.csv lists the realized and
+expected number of events and seismic moment of each catalog, along with
+the master seed and realization needed to regenerate it.
+"""
+
+import gutenbergrichter as gr
+import argparse
+import csv
+import itertools
+import os
+
+# Basic characteristics of seismicity catalog, as in generate_catalog_titan.py
+TCycleHrs = 382.7
+HrsYr = 24.0*365.0
+TCycleYrs = TCycleHrs/HrsYr
+minM = 0.0
+min_m0 = gr.calc_m0(minM)
+secday = 60.0*60.0*24.0
+secyear = secday*365.0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=('Generates Titan catalogs '
+                                                  + 'over a grid of '
+                                                  + 'Gutenberg-Richter '
+                                                  + 'parameters.'))
+    parser.add_argument('--m0totalpercycle', type=float, nargs='+',
+                        default=[2.7e15],
+                        help='Total seismic moment per tidal cycle (Nm)')
+    parser.add_argument('--max-m0', type=float, nargs='+', default=[1.9e16],
+                        help='Moment of the largest possible event (Nm)')
+    parser.add_argument('--b', type=float, nargs='+', default=[1.0],
+                        help='Gutenberg-Richter b-value')
+    parser.add_argument('--max-dep', type=float, nargs='+', default=[2.0],
+                        help='Maximum event depth (km)')
+    parser.add_argument('-c', '--ncycles', type=float, default=10.0,
+                        help='Catalog length in tidal cycles')
+    parser.add_argument('-s', '--seed', type=int,
+                        help='Master seed (random if not given)')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of worker processes')
+    parser.add_argument('-o', '--outdir', default='catalogs/sweep',
+                        help='Output directory')
+    args = parser.parse_args()
+
+    catlength = args.ncycles*TCycleYrs*secyear
+    if not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+
+    grid = list(itertools.product(args.m0totalpercycle, args.max_m0, args.b,
+                                  args.max_dep))
+    gr_objs = []
+    filenames = []
+    for (m0totalpercycle, max_m0, slope, max_dep) in grid:
+        gr_obj = gr.GutenbergRichter(b=slope,
+                                     m0total=m0totalpercycle/TCycleYrs,
+                                     max_m0=max_m0, min_m0=min_m0,
+                                     max_dep=max_dep)
+        gr_obj.calc_a()
+        gr_objs.append(gr_obj)
+        filenames.append(os.path.join(args.outdir,
+                                      'Titan_m0c%.2e_maxm0%.2e_b%.2f_dep%.1f'
+                                      '.pkl' % (m0totalpercycle, max_m0,
+                                                slope, max_dep)))
+
+    (seed, members) = gr.generate_sweep(gr_objs, catlength, filenames,
+                                        seed=args.seed,
+                                        max_deps=[point[3] for point in grid],
+                                        processes=args.processes)
+
+    with open(os.path.join(args.outdir, 'summary.csv'), 'w') as f:
+        output = csv.writer(f)
+        output.writerow(['Filename', 'M0 total per cycle', 'Max M0', 'b',
+                         'Max Depth', 'Events', 'Expected events',
+                         'M0 released', 'Expected M0', 'M0 ratio',
+                         'Master seed', 'Realization'])
+        for (point, gr_obj, member) in zip(grid, gr_objs, members):
+            (realization, filename, nevents, moment) = member
+            nexpected = gr_obj.expected_count(catlength)
+            m0expected = gr_obj.expected_moment(catlength)
+            output.writerow([filename] + list(point) +
+                            [nevents, '%.1f' % nexpected, '%.4g' % moment,
+                             '%.4g' % m0expected,
+                             '%.3f' % (moment/m0expected), seed,
+                             realization])
+            print('%s: %d events (%.0f expected), M0 %.3g (%.3g expected)' %
+                  (filename, nevents, nexpected, moment, m0expected))
+    print('Master seed: %d' % seed)